@@ -7,34 +7,1176 @@ Example configurations not included.
 """
 
 __all__ = ['docker','test','docker_list','docker_recap','test_report','avail',
-	'gitscan','gitcheck','megatest']
+	'gitscan','gitcheck','megatest','docker_history_compact','docker_all','startup','bench','docker_warm',
+	'docker_gc','test_report_all']
 
-import os,sys,re,tempfile,subprocess,shutil,time,json,pwd,datetime,copy,grp
+import os,sys,re,time,json,threading
 str_types = [str,unicode] if sys.version_info<(3,0) else [str]
 
 #! container_user is hardcoded here and in the defaults for building the docker
 container_user = 'biophyscode'
+# transient records which do not belong in the config live in a hidden folder
+docks_state = '.docks'
+# builds and config writes are serialized when tests run in parallel
+docks_lock = threading.RLock()
+# the history is also locked between processes and this counts nested holds (see history_lock)
+docks_history_depth = 0
+# folders which never contain repositories we want to scan
+git_skip = ['node_modules','__pycache__','.tox','.venv','venv']
+# the docker backend is chosen by docker_backend
+docks_backend = None
+# one watcher tracks the exit of every detached container (see container_watcher)
+docks_watcher = None
+# warm containers in use by this process, which are never recycled while busy
+docks_warm_busy = {}
+# interpreted docker configurations keyed by a hash of the config and mods files
+docks_instruct_cache = {}
+# placeholders in dockerfiles are either names (e.g. @USER) or calls (e.g. @read_config('key'))
+# ... and only registered calls are matched so that decorators in inline code pass through
+template_regex = r'(?<![\w.])@([A-Z][A-Z_]*)\b|@(%s)\((.*?)\)'
+# dockerfile texts parsed into tokens by template_parse
+docks_template_cache = {}
+# digests of staged files keyed by the state file which stores them (see file_digest_cached)
+docks_digest_cache = {}
 
-# import for skunkworks
-try: from makeface import write_config,read_config
-except:
-	# import for factory
-	sys.path.insert(0,os.path.join(os.getcwd(),'mill'))
-	from config import write_config,read_config
+# the config is read once per process by read_config
+docks_config = None
+# an object with read_config and write_config which replaces the config module (see bench)
+docks_config_interface = None
 
-def interpret_docker_instructions(config,mods=None):
+def config_interface():
+	"""Import the config functions only when a command needs the config."""
+	if docks_config_interface: return docks_config_interface
+	# import for skunkworks
+	try: import makeface as interface
+	except ImportError:
+		# import for factory
+		sys.path.insert(0,os.path.join(os.getcwd(),'mill'))
+		import config as interface
+	return interface
+
+def read_config(reload=False):
 	"""
-	Read a docker configuration for running things in the docker.
+	Read the config once per process. Every command shares the result and write_config updates it.
+	"""
+	global docks_config
+	with docks_lock:
+		if docks_config==None or reload: docks_config = config_interface().read_config()
+		return docks_config
+
+def write_config(config):
+	"""Write the config and keep it as the copy for the rest of the process."""
+	global docks_config
+	with docks_lock:
+		config_interface().write_config(config)
+		docks_config = config
+
+def state_fn(*names):
+	"""Get a path in the state folder."""
+	fn = os.path.join(docks_state,*names)
+	if not os.path.isdir(os.path.dirname(fn)): os.makedirs(os.path.dirname(fn))
+	return fn
+
+def history_lock():
+	"""
+	Hold the process lock and a file lock on the history folder so that a build appended by another
+	process is not lost while the builds are rewritten. Nested holds take the file lock once.
+	"""
+	import contextlib
+	@contextlib.contextmanager
+	def held():
+		global docks_history_depth
+		with docks_lock:
+			fp = None
+			if docks_history_depth==0:
+				fp = open(state_fn('history','lock'),'a')
+				try:
+					import fcntl
+					fcntl.flock(fp.fileno(),fcntl.LOCK_EX)
+				except ImportError: pass
+			docks_history_depth += 1
+			# closing the file releases the file lock
+			try: yield
+			finally:
+				docks_history_depth -= 1
+				if fp!=None: fp.close()
+	return held()
+
+def history_blob(text):
+	"""Store a dockerfile text in the history by its hash."""
+	import hashlib
+	blob = hashlib.sha1(text.encode('utf-8')).hexdigest()
+	fn = state_fn('history','blobs',blob)
+	if not os.path.isfile(fn):
+		with open(fn+'.tmp','w') as fp: fp.write(text)
+		os.rename(fn+'.tmp',fn)
+	return blob
+
+def history_text(blob):
+	"""Read a dockerfile text from the history."""
+	with open(state_fn('history','blobs',blob)) as fp: return fp.read()
+
+def history_index(update=None):
+	"""
+	Read the small index of the latest build of each image or merge an update into it.
+	"""
+	fn = state_fn('history','latest.json')
+	with history_lock():
+		index = {}
+		if os.path.isfile(fn):
+			with open(fn) as fp: index = json.load(fp)
+		if update:
+			for name,val in update.items(): index[name] = dict(index.get(name,{}),**val)
+			with open(fn+'.tmp','w') as fp: json.dump(index,fp)
+			os.rename(fn+'.tmp',fn)
+	return index
+
+def history_latest(name):
+	"""Get the latest build record for an image from the index."""
+	return history_index().get(name,{})
+
+def history_forget_stage(names):
+	"""
+	Forget the final stage of a sequential build when another build path replaces the image.
+	The intermediate stage images are untouched so a later sequential build can still resume from them.
+	"""
+	with history_lock():
+		index = history_index()
+		history_index(dict([(name,dict(stages=dict([(k,v) for k,v in index[name]['stages'].items()
+			if k!=name]))) for name in names if index.get(name,{}).get('stages')]))
+
+def history_append(name,ts,record,keep=None):
+	"""
+	Append a build to the history. Texts are stored once by hash and builds refer to them.
+	Images with more than twice the keep count in the history are compacted.
+	"""
+	with history_lock():
+		count = history_extend([(name,ts,record)])[name]['count']
+		if keep and count>2*keep: history_compact(keep=keep)
+
+def history_extend(builds):
+	"""
+	Append many (name,ts,record) builds to the history with one write to the builds and the index.
+	Returns the index updates.
+	"""
+	with history_lock():
+		index,update = history_index(),{}
+		with open(state_fn('history','builds.jsonl'),'a') as fp:
+			for name,ts,record in builds:
+				record = dict(record,name=name,ts=ts,
+					texts=[(step,history_blob(text)) for step,text in record.get('texts',[])])
+				fp.write(json.dumps(record)+'\n')
+				count = update.get(name,index.get(name,{})).get('count',0)+1
+				update[name] = dict(ts=ts,digest=record.get('digest'),
+					total_time=record.get('total_time'),count=count)
+		history_index(update)
+	return update
+
+def history_query(name=None,since=None,texts=False):
+	"""
+	Iterate over recorded builds, optionally for one image or since a timestamp (e.g. 2018.05.01).
+	Dockerfile texts are only loaded on request.
+	"""
+	fn = state_fn('history','builds.jsonl')
+	if not os.path.isfile(fn): return
+	with open(fn) as fp:
+		for line in fp:
+			if not line.strip(): continue
+			record = json.loads(line)
+			if name!=None and record['name']!=name: continue
+			if since!=None and record['ts']<since: continue
+			if texts: record['texts'] = [(step,history_text(blob)) for step,blob in record['texts']]
+			yield record
+
+def history_compact(keep=50):
+	"""
+	Retain the most recent builds of each image and remove texts which are no longer referenced.
+	"""
+	keep = int(keep)
+	with history_lock():
+		records = list(history_query())
+		counts,kept = {},[]
+		for record in sorted(records,key=lambda x:x['ts'],reverse=True):
+			counts[record['name']] = counts.get(record['name'],0)+1
+			if counts[record['name']]<=keep: kept.append(record)
+		kept = sorted(kept,key=lambda x:x['ts'])
+		fn = state_fn('history','builds.jsonl')
+		with open(fn+'.tmp','w') as fp:
+			for record in kept: fp.write(json.dumps(record)+'\n')
+		os.rename(fn+'.tmp',fn)
+		blobs = set([blob for record in kept for step,blob in record['texts']])
+		blob_dn = os.path.dirname(state_fn('history','blobs','-'))
+		for blob in os.listdir(blob_dn):
+			if blob not in blobs: os.remove(os.path.join(blob_dn,blob))
+		history_index(dict([(name,dict(count=min(count,keep))) for name,count in counts.items()]))
+	print('[STATUS] compacted the history from %d to %d builds'%(len(records),len(kept)))
+
+def history_event_done(fingerprint):
+	"""Check for a completed testset event by its fingerprint."""
+	return os.path.isfile(state_fn('history','events',fingerprint))
+
+def history_event(event,fingerprint,ts=None):
+	"""Record a completed testset event with a marker for the fingerprint and the full payload."""
+	ts = ts or time.strftime('%Y.%m.%d.%H%M')
+	with docks_lock:
+		with open(state_fn('history','events.jsonl'),'a') as fp:
+			fp.write(json.dumps(dict(fingerprint=fingerprint,ts=ts,event=event),default=repr)+'\n')
+		with open(state_fn('history','events',fingerprint),'w') as fp: fp.write(ts)
+
+def history_migrate():
+	"""
+	Move the docker_history and testset_history out of the config and into the history store.
+	"""
+	with docks_lock:
+		config = read_config()
+		if not any([i in config for i in ['docker_history','testset_history','docker_digests']]): return
+		docker_history = config.pop('docker_history',{})
+		# the index is written once rather than once per build
+		history_extend([(name,ts,docker_history[(name,ts)])
+			for name,ts in sorted(docker_history.keys(),key=lambda x:x[1])])
+		# digests in the config always belong to the latest build of each image
+		digests = config.pop('docker_digests',{})
+		history_index(dict([(name,dict(digest=digest)) for name,digest in digests.items()]))
+		testset_history = config.pop('testset_history',{})
+		for event in testset_history.get('events',[]): history_event(event,event_fingerprint(event))
+		for fingerprint,ts in testset_history.get('fingerprints',{}).items():
+			if not history_event_done(fingerprint): 
+				with open(state_fn('history','events',fingerprint),'w') as fp: fp.write(ts or '')
+		# payloads were previously appended to a separate file in the state folder
+		if os.path.isfile(state_fn('testset-events.jsonl')):
+			with open(state_fn('testset-events.jsonl')) as fp_in:
+				with open(state_fn('history','events.jsonl'),'a') as fp_out: fp_out.write(fp_in.read())
+			os.remove(state_fn('testset-events.jsonl'))
+		write_config(config)
+		print('[STATUS] moved %d builds and the testset history from the config to %s'%(
+			len(docker_history),os.path.dirname(state_fn('history','-'))))
+
+def file_digest(fn,chunk=2**20):
+	"""Hash the contents of a file in chunks."""
+	import hashlib
+	digest = hashlib.sha1()
+	with open(fn,'rb') as fp:
+		for block in iter(lambda:fp.read(chunk),b''): digest.update(block)
+	return digest.hexdigest()
+
+def file_digest_cached(fn):
+	"""
+	Hash a file unless its path, size, modification time and inode match a digest we already have.
+	Digests are kept in the state folder so that large requirements are only hashed when they change.
+	"""
+	stat = os.stat(fn)
+	path,stamp = os.path.abspath(fn),[stat.st_size,stat.st_mtime,stat.st_ino]
+	cache_fn = os.path.abspath(state_fn('digests.json'))
+	with docks_lock:
+		if cache_fn not in docks_digest_cache:
+			cache = {}
+			if os.path.isfile(cache_fn):
+				with open(cache_fn) as fp: cache = json.load(fp)
+			# forget files which are gone
+			docks_digest_cache[cache_fn] = dict([(k,v) for k,v in cache.items() if os.path.isfile(k)])
+		cache = docks_digest_cache[cache_fn]
+		if cache.get(path,{}).get('stamp')==stamp: return cache[path]['digest']
+	digest = file_digest(fn)
+	with docks_lock:
+		cache[path] = dict(stamp=stamp,digest=digest)
+		with open(cache_fn+'.tmp','w') as fp: json.dump(cache,fp)
+		os.rename(cache_fn+'.tmp',cache_fn)
+	return digest
+
+def stage_fingerprints(texts,staged):
+	"""
+	Fingerprint each stage of a sequential build by the cumulative hash of every stage up to it.
+	The files staged for a step are included at the position of that step.
+	"""
+	import hashlib
+	digest,fingerprints = hashlib.sha1(),[]
+	for step,text in texts:
+		digest.update(('%s\n%s\n'%(step,text)).encode('utf-8'))
+		for fn in sorted(staged.get(step,[])):
+			digest.update(('%s %s\n'%(os.path.basename(fn),file_digest_cached(fn))).encode('utf-8'))
+		fingerprints.append(digest.copy().hexdigest())
+	return fingerprints
+
+def docker_digest(texts,staged):
+	"""
+	Hash the rendered dockerfile texts along with the contents of every file staged for the build.
 	"""
+	import hashlib
+	digest = hashlib.sha1()
+	digest.update(json.dumps([list(i) for i in texts]).encode('utf-8'))
+	for fn in sorted(staged): 
+		digest.update(('%s %s\n'%(os.path.basename(fn),file_digest_cached(fn))).encode('utf-8'))
+	return digest.hexdigest()
+
+def stage_reflink(source,target):
+	"""Clone a file on filesystems with copy-on-write support (e.g. btrfs, xfs)."""
+	import shutil
+	try: import fcntl
+	except ImportError: return False
+	# FICLONE from linux/fs.h
+	ficlone = 0x40049409
+	try:
+		with open(source,'rb') as fp_in, open(target,'wb') as fp_out:
+			fcntl.ioctl(fp_out.fileno(),ficlone,fp_in.fileno())
+	except (IOError,OSError):
+		if os.path.isfile(target): os.remove(target)
+		return False
+	shutil.copystat(source,target)
+	return True
+
+def stage_file(source,target,link=True):
+	"""
+	Sync a single file to a target unless the target already matches by size, mtime, or hash.
+	Hardlinks are only allowed for targets which are never modified, namely build contexts.
+	"""
+	import shutil
+	if os.path.isfile(target) and not os.path.islink(target):
+		stat_s,stat_t = os.stat(source),os.stat(target)
+		if stat_s.st_size==stat_t.st_size:
+			if (stat_s.st_dev,stat_s.st_ino)==(stat_t.st_dev,stat_t.st_ino): return False
+			if stat_s.st_mtime==stat_t.st_mtime: return False
+			# a new timestamp on a file with the same size requires a hash before we copy
+			if file_digest(source)==file_digest(target):
+				os.utime(target,(stat_s.st_atime,stat_s.st_mtime))
+				return False
+		os.remove(target)
+	elif os.path.lexists(target): os.remove(target)
+	if not os.path.isdir(os.path.dirname(target)): os.makedirs(os.path.dirname(target))
+	# prefer a hardlink, then a reflink, then a full copy
+	if link:
+		try: 
+			os.link(source,target)
+			return True
+		except OSError: pass
+	if not stage_reflink(source,target): shutil.copy2(source,target)
+	return True
+
+def stage_sync(sources,dest,link=True,prune=False):
+	"""
+	Sync files into a folder from a dictionary of target names to source paths.
+	Only changed files are copied and the prune flag removes anything else in the folder.
+	"""
+	import shutil
+	if not os.path.isdir(dest): os.makedirs(dest)
+	if prune:
+		for fn in os.listdir(dest):
+			if fn in sources: continue
+			path = os.path.join(dest,fn)
+			if os.path.isdir(path) and not os.path.islink(path): shutil.rmtree(path)
+			else: os.remove(path)
+	changed = [target for target,source in sorted(sources.items()) 
+		if stage_file(source,os.path.join(dest,target),link=link)]
+	if changed: print('[STATUS] staged %d of %d files in %s'%(len(changed),len(sources),dest))
+	return changed
+
+def template_parse(text,calls=('read_config',)):
+	"""
+	Split a dockerfile text into literal strings and placeholder tokens.
+	Tokens are (name,None) for names and (name,argument) for calls with a literal argument.
+	"""
+	import ast
+	key = (text,tuple(sorted(calls)))
+	if key in docks_template_cache: return docks_template_cache[key]
+	tokens,pos = [],0
+	# an empty alternation never matches a call
+	regex = re.compile(template_regex%('|'.join([re.escape(i) for i in sorted(calls)]) or '(?!)'),flags=re.M)
+	for match in regex.finditer(text):
+		tokens.append(text[pos:match.start()])
+		if match.group(1): tokens.append((match.group(1),None))
+		else:
+			try: arg = ast.literal_eval(match.group(3))
+			except (ValueError,SyntaxError): 
+				raise Exception('placeholder %s needs a literal argument'%match.group(0))
+			tokens.append((match.group(2),arg))
+		pos = match.end()
+	tokens.append(text[pos:])
+	docks_template_cache[key] = tokens
+	return tokens
+
+def template_render(texts,names,calls):
+	"""
+	Render placeholders for a list of (step,text) pairs in a single pass.
+	Every unknown placeholder is reported before we render anything.
+	"""
+	parsed = [(step,template_parse(text,calls=list(calls.keys()))) for step,text in texts]
+	unknown = set()
+	for step,tokens in parsed:
+		for token in tokens:
+			if type(token) in str_types: continue
+			if token[1]==None and token[0] not in names: unknown.add('%s: @%s'%(step,token[0]))
+	if unknown: raise Exception('unknown placeholders in the dockerfiles: %s'%', '.join(sorted(unknown)))
+	return [(step,''.join([token if type(token) in str_types else 
+		(names[token[0]] if token[1]==None else calls[token[0]](token[1])) 
+		for token in tokens])) for step,tokens in parsed]
+
+class DockerError(Exception):
+	"""A docker operation failed."""
+	def __init__(self,message,status=None):
+		Exception.__init__(self,message)
+		self.status = status
+
+class DockerNotFound(DockerError):
+	"""A container or image does not exist."""
+
+class DockerBuildError(DockerError):
+	"""A docker build failed."""
+
+class DockerCLI(object):
+	"""
+	Run docker operations through the docker command line.
+	"""
+	name = 'cli'
+	def build(self,tag,dockerfile,context,on_line=None):
+		import subprocess
+		cmd = ['docker','build','-t',tag,'-f',dockerfile,os.path.join(context,'')]
+		print('[STATUS] running "%s"'%' '.join(cmd))
+		proc = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+		for line in iter(proc.stdout.readline,b''):
+			line = line.decode('utf-8','replace')
+			sys.stdout.write(line)
+			if on_line: on_line(line.rstrip('\n'))
+		if proc.wait()!=0: raise DockerBuildError('failed to build %s'%tag,status=proc.returncode)
+	def run(self,spec):
+		import subprocess
+		cmd = ('docker run %s%s-u %s %s%s %s%s'%(
+			'--name=%s '%spec['name'] if spec.get('name') else '',
+			'-d ' if spec.get('detach') else '--rm -it ',spec['user'],
+			' '.join(['-v %s:%s'%i for i in spec.get('volumes',[])]),
+			''.join([' --publish=%d:%d'%tuple(i) for i in spec.get('ports',[])]),
+			spec['image'],''.join([' %s'%i for i in spec.get('command',[])])))
+		print('[STATUS] calling docker via: %s'%cmd)
+		# check_call raises exception on failure
+		try: subprocess.check_call(cmd,shell=True)
+		except subprocess.CalledProcessError as e:
+			raise DockerError('failed to run %s'%spec['image'],status=e.returncode)
+	def wait(self,name):
+		import subprocess
+		try: return int(subprocess.check_output(['docker','wait',name]).decode('utf-8').strip())
+		except subprocess.CalledProcessError as e:
+			raise DockerNotFound('cannot wait for container %s'%name,status=e.returncode)
+	def logs(self,name,follow=True,chunk=2**16):
+		import subprocess
+		proc = subprocess.Popen(['docker','logs']+(['-f'] if follow else [])+[name],
+			stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+		while True:
+			block = os.read(proc.stdout.fileno(),chunk)
+			if not block: break
+			yield block
+		if proc.wait()!=0: raise DockerNotFound('cannot get logs for container %s'%name,
+			status=proc.returncode)
+	def remove(self,name):
+		import subprocess
+		if subprocess.call(['docker','rm',name])!=0:
+			raise DockerNotFound('cannot remove container %s'%name)
+	def image_exists(self,tag):
+		import subprocess
+		with open(os.devnull,'w') as null:
+			return subprocess.call(['docker','image','inspect',tag],stdout=null,stderr=null)==0
+	def image_id(self,tag):
+		import subprocess
+		with open(os.devnull,'w') as null:
+			try: return subprocess.check_output(['docker','image','inspect','-f','{{.Id}}',tag],
+				stderr=null).decode('utf-8').strip()
+			except subprocess.CalledProcessError: raise DockerNotFound('cannot find image %s'%tag)
+	def running(self,name):
+		import subprocess
+		with open(os.devnull,'w') as null:
+			proc = subprocess.Popen(['docker','inspect','-f','{{.State.Running}}',name],
+				stdout=subprocess.PIPE,stderr=null)
+			return proc.communicate()[0].decode('utf-8').strip()=='true'
+	def execute(self,name,command,user,status,chunk=2**16):
+		import subprocess
+		proc = subprocess.Popen(['docker','exec','-u',user,name]+list(command),
+			stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+		while True:
+			block = os.read(proc.stdout.fileno(),chunk)
+			if not block: break
+			yield block
+		status['exit_code'] = proc.wait()
+	def events(self,since=None,control=None):
+		import subprocess
+		cmd = ['docker','events','--filter','type=container','--filter','event=die',
+			'--format','{{json .}}']+(['--since','%d'%since] if since else [])
+		proc = subprocess.Popen(cmd,stdout=subprocess.PIPE)
+		if control!=None: control['close'] = proc.terminate
+		for line in iter(proc.stdout.readline,b''):
+			try: yield json.loads(line.decode('utf-8'))
+			except ValueError: continue
+		proc.wait()
+	def states(self,names):
+		import subprocess
+		with open(os.devnull,'w') as null:
+			proc = subprocess.Popen(['docker','inspect','-f',
+				'{{.Name}} {{.State.Running}} {{.State.ExitCode}}']+list(names),
+				stdout=subprocess.PIPE,stderr=null)
+			text = proc.communicate()[0].decode('utf-8')
+		states = {}
+		for line in text.splitlines():
+			if len(line.split())!=3: continue
+			name,running,exit_code = line.split()
+			states[name.lstrip('/')] = dict(running=running=='true',exit_code=int(exit_code))
+		return states
+	def listing(self,cmd):
+		import subprocess
+		try: text = subprocess.check_output(cmd+['--format','{{json .}}']).decode('utf-8')
+		except subprocess.CalledProcessError as e:
+			raise DockerError('failed to run %s'%' '.join(cmd),status=e.returncode)
+		return [json.loads(i) for i in text.splitlines() if i.strip()]
+	def images(self):
+		return [dict(tag='%s:%s'%(i['Repository'],i['Tag']),id=i['ID'],size=parse_size(i['Size']))
+			for i in self.listing(['docker','images'])]
+	def containers(self):
+		return [dict(name=i['Names'],image=i['Image'],created=i['CreatedAt'],
+			running=i.get('State',i['Status'].split()[0].lower()) in ['running','up'])
+			for i in self.listing(['docker','ps','-a'])]
+	def remove_image(self,tag):
+		import subprocess
+		if subprocess.call(['docker','rmi',tag])!=0: raise DockerNotFound('cannot remove image %s'%tag)
+	def disk_usage(self):
+		return sum([parse_size(i['Size']) for i in self.listing(['docker','system','df'])
+			if i['Type'] in ['Images','Containers']])
+	def inspect(self,name):
+		import subprocess
+		try: text = subprocess.check_output(['docker','inspect','-f','{{.Id}} {{.State.Pid}}',name])
+		except subprocess.CalledProcessError as e:
+			raise DockerNotFound('cannot inspect container %s'%name,status=e.returncode)
+		ident,pid = text.decode('utf-8').split()
+		return dict(id=ident,pid=int(pid))
+	def stats(self,name):
+		import subprocess
+		try: text = subprocess.check_output(['docker','stats','--no-stream','--format','{{json .}}',name])
+		except subprocess.CalledProcessError as e:
+			raise DockerNotFound('cannot get stats for container %s'%name,status=e.returncode)
+		item = json.loads(text.decode('utf-8'))
+		# the command line only reports the current CPU rate and sizes as text
+		pair = lambda x:[parse_size(i) for i in x.split('/')]
+		(read,write),(rx,tx) = pair(item['BlockIO']),pair(item['NetIO'])
+		return dict(cpu_percent=float(item['CPUPerc'].rstrip('%')),mem=pair(item['MemUsage'])[0],
+			read=read,write=write,rx=rx,tx=tx)
+
+class DockerAPI(object):
+	"""
+	Talk to the Docker Engine API over its unix socket with a small pool of persistent connections.
+	Interactive runs need a terminal so they always go through the command line.
+	"""
+	name = 'api'
+	def __init__(self,socket_fn='/var/run/docker.sock',timeout=None):
+		self.socket_fn = socket_fn
+		self.timeout = timeout
+		self.idle = []
+		self.lock = threading.Lock()
+	def connect(self):
+		try: import http.client as http_client
+		except ImportError: import httplib as http_client
+		import socket
+		conn = http_client.HTTPConnection('localhost',timeout=self.timeout)
+		def connect_unix():
+			sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+			if self.timeout: sock.settimeout(self.timeout)
+			sock.connect(self.socket_fn)
+			conn.sock = sock
+		conn.connect = connect_unix
+		return conn
+	def request(self,method,path,body=None,headers=None,stream=False):
+		"""Send a request on a pooled connection and return the response or a stream of chunks."""
+		headers = dict(headers or {})
+		if isinstance(body,(dict,list)):
+			body = json.dumps(body).encode('utf-8')
+			headers['Content-Type'] = 'application/json'
+		for attempt in range(2):
+			with self.lock: conn = self.idle.pop() if self.idle else self.connect()
+			if hasattr(body,'seek'): body.seek(0)
+			try:
+				conn.request(method,path,body=body,headers=headers)
+				resp = conn.getresponse()
+				break
+			except (IOError,OSError) as e:
+				conn.close()
+				# a pooled connection may have been closed by the daemon so we retry once
+				if attempt==1: raise DockerError('cannot reach docker at %s: %s'%(self.socket_fn,e))
+		if resp.status>=400:
+			text = resp.read().decode('utf-8','replace')
+			self.release(conn,resp)
+			try: message = json.loads(text).get('message',text)
+			except ValueError: message = text
+			raise (DockerNotFound if resp.status==404 else DockerError)(
+				'%s %s: %s'%(method,path,message.strip()),status=resp.status)
+		if stream: return self.stream(conn,resp)
+		text = resp.read()
+		self.release(conn,resp)
+		return json.loads(text.decode('utf-8')) if text.strip() else None
+	def release(self,conn,resp):
+		if resp.will_close: conn.close()
+		else:
+			with self.lock: self.idle.append(conn)
+	def stream(self,conn,resp,chunk=2**16):
+		reader = getattr(resp,'read1',resp.read)
+		try:
+			while True:
+				block = reader(chunk)
+				if not block: break
+				yield block
+		finally:
+			if resp.isclosed(): self.release(conn,resp)
+			else: conn.close()
+	def stream_json(self,chunks):
+		"""Decode a stream of concatenated JSON objects."""
+		decoder,buffer = json.JSONDecoder(),''
+		for block in chunks:
+			buffer += block.decode('utf-8','replace')
+			while True:
+				buffer = buffer.lstrip()
+				if not buffer: break
+				try: item,end = decoder.raw_decode(buffer)
+				except ValueError: break
+				buffer = buffer[end:]
+				yield item
+	def build(self,tag,dockerfile,context,on_line=None):
+		import tarfile,tempfile
+		try: from urllib.parse import urlencode
+		except ImportError: from urllib import urlencode
+		print('[STATUS] building %s via the docker API at %s'%(tag,self.socket_fn))
+		# the context is spooled to disk so that large inputs do not sit in memory
+		with tempfile.TemporaryFile() as fp:
+			with tarfile.open(fileobj=fp,mode='w') as tar: tar.add(context,arcname='.')
+			size = fp.tell()
+			fp.seek(0)
+			query = urlencode(dict(t=tag,dockerfile=os.path.relpath(dockerfile,context)))
+			chunks = self.request('POST','/build?%s'%query,body=fp,stream=True,
+				headers={'Content-Type':'application/x-tar','Content-Length':str(size)})
+			if on_line: on_line('Sending build context to Docker daemon  %dB'%size)
+			for item in self.stream_json(chunks):
+				if 'error' in item: raise DockerBuildError('failed to build %s: %s'%(tag,item['error']))
+				for line in item.get('stream','').splitlines(True):
+					sys.stdout.write(line)
+					if on_line: on_line(line.rstrip('\n'))
+	def run(self,spec):
+		if not spec.get('detach'): return DockerCLI().run(spec)
+		try: from urllib.parse import urlencode
+		except ImportError: from urllib import urlencode
+		ports = ['%d/tcp'%i[1] for i in spec.get('ports',[])]
+		body = dict(Image=spec['image'],Cmd=spec.get('command') or None,User=spec['user'],
+			ExposedPorts=dict([(i,{}) for i in ports]),HostConfig=dict(
+				Binds=['%s:%s'%i for i in spec.get('volumes',[])],
+				PortBindings=dict([('%d/tcp'%c,[{'HostPort':str(h)}]) for h,c in spec.get('ports',[])])))
+		print('[STATUS] calling docker via the API: %s'%json.dumps(body))
+		query = '?%s'%urlencode(dict(name=spec['name'])) if spec.get('name') else ''
+		container = self.request('POST','/containers/create%s'%query,body=body)
+		self.request('POST','/containers/%s/start'%container['Id'])
+		return container['Id']
+	def wait(self,name):
+		return int(self.request('POST','/containers/%s/wait'%name)['StatusCode'])
+	def logs(self,name,follow=True,chunk=2**16):
+		tty = self.request('GET','/containers/%s/json'%name)['Config'].get('Tty',False)
+		chunks = self.request('GET','/containers/%s/logs?stdout=1&stderr=1&follow=%d'%(
+			name,int(follow)),stream=True)
+		if tty:
+			for block in chunks: yield block
+			return
+		for block in self.demux(chunks): yield block
+	def demux(self,chunks):
+		"""Without a terminal the output is multiplexed into frames with an eight byte header."""
+		import struct
+		buffer = b''
+		for block in chunks:
+			buffer += block
+			while len(buffer)>=8:
+				size = struct.unpack('>I',buffer[4:8])[0]
+				if len(buffer)<8+size: break
+				yield buffer[8:8+size]
+				buffer = buffer[8+size:]
+	def remove(self,name):
+		self.request('DELETE','/containers/%s'%name)
+	def image_exists(self,tag):
+		try: self.request('GET','/images/%s/json'%tag)
+		except DockerNotFound: return False
+		return True
+	def image_id(self,tag):
+		return self.request('GET','/images/%s/json'%tag)['Id']
+	def running(self,name):
+		try: return self.request('GET','/containers/%s/json'%name)['State'].get('Running',False)
+		except DockerNotFound: return False
+	def execute(self,name,command,user,status,chunk=2**16):
+		handle = self.request('POST','/containers/%s/exec'%name,body=dict(
+			AttachStdout=True,AttachStderr=True,Cmd=list(command),User=user))
+		chunks = self.request('POST','/exec/%s/start'%handle['Id'],
+			body=dict(Detach=False,Tty=False),stream=True)
+		for block in self.demux(chunks): yield block
+		status['exit_code'] = int(self.request('GET','/exec/%s/json'%handle['Id'])['ExitCode'])
+	def events(self,since=None,control=None):
+		import socket
+		try: import http.client as http_client
+		except ImportError: import httplib as http_client
+		try: from urllib.parse import urlencode
+		except ImportError: from urllib import urlencode
+		query = dict(filters=json.dumps(dict(type=['container'],event=['die'])))
+		if since: query['since'] = '%d'%since
+		# the event stream gets its own connection so that it can be closed from another thread
+		conn = self.connect()
+		try:
+			conn.request('GET','/events?%s'%urlencode(query))
+			resp = conn.getresponse()
+			if resp.status>=400: raise DockerError('cannot follow docker events: %s'%
+				resp.read().decode('utf-8','replace').strip(),status=resp.status)
+			if control!=None: control['close'] = lambda:conn.sock.shutdown(socket.SHUT_RDWR)
+			reader = getattr(resp,'read1',resp.read)
+			for item in self.stream_json(iter(lambda:reader(2**16),b'')): yield item
+		# closing the stream from another thread interrupts the read
+		except (IOError,OSError,ValueError,http_client.HTTPException): return
+		finally: conn.close()
+	def states(self,names):
+		try: from urllib.parse import urlencode
+		except ImportError: from urllib import urlencode
+		# one listing covers every container and only exited ones need an inspection for the exit code
+		query = urlencode(dict(all=1,filters=json.dumps(dict(name=list(names)))))
+		states = {}
+		for item in self.request('GET','/containers/json?%s'%query):
+			for name in [i.lstrip('/') for i in item.get('Names',[])]:
+				if name not in names: continue
+				states[name] = dict(running=item.get('State')=='running',exit_code=None)
+				if not states[name]['running']:
+					try: states[name]['exit_code'] = int(self.request('GET',
+						'/containers/%s/json'%name)['State']['ExitCode'])
+					except DockerNotFound: del states[name]
+		return states
+	def images(self):
+		return [dict(tag=tag,id=i['Id'],size=i['Size'])
+			for i in self.request('GET','/images/json') for tag in (i.get('RepoTags') or [])]
+	def containers(self):
+		return [dict(name=i['Names'][0].lstrip('/'),image=i['Image'],created=i['Created'],
+			running=i['State']=='running') for i in self.request('GET','/containers/json?all=1')]
+	def remove_image(self,tag):
+		self.request('DELETE','/images/%s'%tag)
+	def disk_usage(self):
+		usage = self.request('GET','/system/df')
+		return usage.get('LayersSize',0)+sum([i.get('SizeRw',0) for i in usage.get('Containers') or []])
+	def inspect(self,name):
+		item = self.request('GET','/containers/%s/json'%name)
+		return dict(id=item['Id'],pid=item['State'].get('Pid'))
+	def stats(self,name):
+		item = self.request('GET','/containers/%s/stats?stream=0&one-shot=1'%name)
+		blkio = item.get('blkio_stats',{}).get('io_service_bytes_recursive') or []
+		networks = (item.get('networks') or {}).values()
+		return dict(cpu_total=item['cpu_stats']['cpu_usage']['total_usage']/10.**9,
+			mem=item.get('memory_stats',{}).get('usage',0),
+			read=sum([i['value'] for i in blkio if i['op'].lower()=='read']),
+			write=sum([i['value'] for i in blkio if i['op'].lower()=='write']),
+			rx=sum([i.get('rx_bytes',0) for i in networks]),tx=sum([i.get('tx_bytes',0) for i in networks]))
+
+class BuildProfiler(object):
+	"""
+	Follow docker build output to time each instruction, detect cached layers, and find the context size.
+	Handles the classic builder ("Step 2/5 : RUN ...") and plain BuildKit output ("#5 [2/5] RUN ...").
+	"""
+	units = {'B':1,'kB':10**3,'KB':10**3,'MB':10**6,'GB':10**9,'KiB':2**10,'MiB':2**20,'GiB':2**30}
+	regex_step = re.compile(r'^Step (\d+)/(\d+) : (.*)$')
+	regex_context = re.compile(r'^Sending build context to Docker daemon\s+([\d.]+)\s*([kKMG]i?B|B)')
+	regex_kit_step = re.compile(r'^#(\d+) \[(?:[\w-]+ )?(\d+)/(\d+)\] (.*)$')
+	regex_kit_done = re.compile(r'^#(\d+) (CACHED|DONE ([\d.]+)s)')
+	regex_kit_context = re.compile(r'^#\d+ transferring context: ([\d.]+)([kKMG]i?B|B)')
+	def __init__(self):
+		self.steps,self.context_size,self.kit = [],None,{}
+		self.last = None
+	def close(self,now=None):
+		if self.last!=None and self.last.get('elapsed')==None:
+			self.last['elapsed'] = (now or time.time())-self.last.pop('start')
+	def feed(self,line):
+		now = time.time()
+		match = self.regex_step.match(line)
+		if match:
+			self.close(now)
+			self.last = dict(step=int(match.group(1)),instruction=match.group(3).strip(),
+				cached=False,start=now,elapsed=None)
+			self.steps.append(self.last)
+			return
+		if line.strip()=='---> Using cache' and self.last!=None:
+			self.last['cached'] = True
+			return
+		match = self.regex_context.match(line) or self.regex_kit_context.match(line)
+		if match:
+			self.context_size = int(float(match.group(1))*self.units[match.group(2)])
+			return
+		match = self.regex_kit_step.match(line)
+		if match and match.group(1) not in self.kit:
+			self.kit[match.group(1)] = dict(step=int(match.group(2)),instruction=match.group(4).strip(),
+				cached=False,start=now,elapsed=None)
+			self.steps.append(self.kit[match.group(1)])
+			return
+		match = self.regex_kit_done.match(line)
+		if match and match.group(1) in self.kit:
+			step = self.kit[match.group(1)]
+			step['start'] = step.pop('start',now)
+			if match.group(2)=='CACHED': step.update(cached=True,elapsed=0.0)
+			else: step['elapsed'] = float(match.group(3))
+	def record(self):
+		self.close()
+		steps = [dict([(k,v) for k,v in i.items() if k!='start']) for i in self.steps]
+		return dict(steps=steps,context_size=self.context_size,
+			cache_hits=len([i for i in steps if i['cached']]),cache_total=len(steps))
+
+class DockerFake(object):
+	"""
+	Stand-in backend which returns immediately so we can measure the time spent in this module.
+	It prints classic build output with cache hits for repeated layers and logs a completed test.
+	"""
+	name = 'fake'
+	def __init__(self):
+		try: import queue
+		except ImportError: import Queue as queue
+		self.tags,self.layers,self.specs,self.ids = set(),set(),{},{}
+		self.exits = queue.Queue()
+	def build(self,tag,dockerfile,context,on_line=None):
+		import hashlib
+		with open(dockerfile) as fp: lines = [i for i in fp.read().splitlines() if re.match('^[A-Z]+ ',i)]
+		layer = hashlib.sha1()
+		if on_line: on_line('Sending build context to Docker daemon  %dB'%sum(
+			[os.path.getsize(os.path.join(context,i)) for i in os.listdir(context)]))
+		for num,line in enumerate(lines):
+			layer.update(line.encode('utf-8'))
+			if on_line: on_line('Step %d/%d : %s'%(num+1,len(lines),line))
+			if layer.hexdigest() in self.layers and on_line: on_line(' ---> Using cache')
+			self.layers.add(layer.hexdigest())
+		self.tags.add(tag)
+		self.ids[tag] = 'sha256:'+layer.hexdigest()
+	def run(self,spec):
+		if spec.get('name'): self.specs[spec['name']] = spec
+		# detached containers exit as soon as they start
+		if spec.get('name') and spec.get('detach') and spec.get('command')!=['tail','-f','/dev/null']:
+			self.exits.put(dict(status='die',Actor=dict(Attributes=dict(name=spec['name'],exitCode='0'))))
+	def wait(self,name):
+		if name not in self.specs: raise DockerNotFound('cannot wait for container %s'%name)
+		return 0
+	def logs(self,name,follow=True,chunk=2**16):
+		if name not in self.specs: raise DockerNotFound('cannot get logs for container %s'%name)
+		yield b'unit test is complete\n'
+	def remove(self,name):
+		if self.specs.pop(name,None)==None: raise DockerNotFound('cannot remove container %s'%name)
+	def image_exists(self,tag):
+		return tag in self.tags
+	def image_id(self,tag):
+		if tag not in self.ids: raise DockerNotFound('cannot find image %s'%tag)
+		return self.ids[tag]
+	def running(self,name):
+		return name in self.specs
+	def execute(self,name,command,user,status,chunk=2**16):
+		if name not in self.specs: raise DockerNotFound('cannot exec in container %s'%name)
+		yield b'unit test is complete\n'
+		status['exit_code'] = 0
+	def events(self,since=None,control=None):
+		stop = threading.Event()
+		if control!=None: control['close'] = stop.set
+		while not stop.is_set():
+			try: yield self.exits.get(timeout=0.05)
+			except Exception: continue
+	def states(self,names):
+		return dict([(name,dict(running=self.specs[name].get('command')==['tail','-f','/dev/null'],
+			exit_code=0)) for name in names if name in self.specs])
+	def images(self):
+		return [dict(tag='%s:latest'%i,id=i,size=2**20) for i in sorted(self.tags)]
+	def containers(self):
+		return [dict(name=name,image=spec['image'],created=name,
+			running=spec.get('command')==['tail','-f','/dev/null']) for name,spec in self.specs.items()]
+	def remove_image(self,tag):
+		if tag.split(':')[0] not in self.tags: raise DockerNotFound('cannot remove image %s'%tag)
+		self.tags.remove(tag.split(':')[0])
+	def disk_usage(self):
+		return len(self.tags)*2**20
+	def inspect(self,name):
+		if name not in self.specs: raise DockerNotFound('cannot inspect container %s'%name)
+		return dict(id='fake-%s'%name,pid=None)
+	def stats(self,name):
+		if name not in self.specs: raise DockerNotFound('cannot get stats for container %s'%name)
+		return dict(cpu_total=time.time()%1000,mem=2**20,read=0,write=0,rx=0,tx=0)
+
+class ContainerWatcher(object):
+	"""
+	Track the exit of many detached containers at once with one subscription to the docker events,
+	or by checking all pending containers in one batch every `poll` seconds.
+	Callbacks for each container (e.g. finishing logs and cleaning up) run in a small pool on exit.
+	A stream for each container (e.g. following its log) runs while it is alive and ends before the callbacks.
+	"""
+	def __init__(self,backend,poll=None,workers=4):
+		self.backend,self.poll,self.workers = backend,poll,workers
+		self.lock = threading.Lock()
+		self.watches,self.control = {},{}
+		self.thread,self.pool,self.stopped = None,None,False
+		# docker replays events since this time so that we never miss an exit while subscribing
+		self.since = int(time.time())-1
+	def watch(self,name,on_exit=None,stream=None):
+		"""
+		Start tracking a container. Callbacks receive the container name and exit code.
+		The stream receives the container name and should return once the container exits.
+		"""
+		from multiprocessing.pool import ThreadPool
+		with self.lock:
+			self.watches[name] = dict(name=name,on_exit=list(on_exit or []),
+				done=threading.Event(),exit_code=None,finishing=False,stream=None)
+			if stream:
+				thread = threading.Thread(target=self.streaming,args=(name,stream))
+				thread.daemon = True
+				thread.start()
+				self.watches[name]['stream'] = thread
+			if not self.thread:
+				self.pool = ThreadPool(self.workers)
+				self.thread = threading.Thread(target=self.follow)
+				self.thread.daemon = True
+				self.thread.start()
+		# the container may have exited before the subscription started
+		self.check([name])
+	def wait(self,name,timeout=None):
+		"""Wait for a container and its callbacks and return its exit code."""
+		watch = self.watches[name]
+		watch['done'].wait(timeout)
+		if not watch['done'].is_set(): raise DockerError('timed out waiting for container %s'%name)
+		with self.lock: del self.watches[name]
+		return watch['exit_code']
+	def check(self,names):
+		states = self.backend.states(names) if names else {}
+		for name in names:
+			if name not in states:
+				print('[WARNING] cannot find the container %s'%name)
+				self.finish(name,None)
+			elif not states[name]['running']: self.finish(name,states[name]['exit_code'])
+	def finish(self,name,exit_code):
+		with self.lock:
+			watch = self.watches.get(name)
+			if not watch or watch['finishing']: return
+			watch.update(finishing=True,exit_code=exit_code)
+		self.pool.apply_async(self.complete,(watch,))
+	def streaming(self,name,stream):
+		try: stream(name)
+		except Exception as e: print('[WARNING] stream failed for container %s: %s'%(name,e))
+	def complete(self,watch):
+		# the stream sees the end of the output shortly after the exit
+		if watch['stream']: watch['stream'].join()
+		for callback in watch['on_exit']:
+			try: callback(watch['name'],watch['exit_code'])
+			except Exception as e: print('[WARNING] callback failed for container %s: %s'%(watch['name'],e))
+		watch['done'].set()
+	def follow(self):
+		while not self.stopped:
+			if not self.poll:
+				try:
+					for event in self.backend.events(since=self.since,control=self.control):
+						attributes = event.get('Actor',{}).get('Attributes',{})
+						exit_code = attributes.get('exitCode')
+						self.finish(attributes.get('name'),int(exit_code) if exit_code!=None else None)
+						if self.stopped: break
+				except DockerError as e: print('[WARNING] lost the docker events: %s'%e)
+				if self.stopped: break
+				# without events we fall back to polling
+				print('[WARNING] the docker event stream ended so we are polling instead')
+				self.poll = 1.0
+			time.sleep(self.poll)
+			with self.lock: names = [k for k,v in self.watches.items() if not v['finishing']]
+			self.check(names)
+	def stop(self):
+		self.stopped = True
+		if self.control.get('close'):
+			try: self.control['close']()
+			except Exception: pass
+		if self.thread: self.thread.join(1)
+		if self.pool:
+			self.pool.close()
+			self.pool.join()
+
+def container_watcher():
+	"""
+	Get the watcher for detached containers which is shared by every test in this process.
+	Set `docks_watch_poll` in the config to a number of seconds to poll instead of following events.
+	"""
+	global docks_watcher
+	with docks_lock:
+		if docks_watcher: return docks_watcher
+		import atexit
+		poll = read_config().get('docks_watch_poll')
+		docks_watcher = ContainerWatcher(docker_backend(),poll=float(poll) if poll else None)
+		atexit.register(docks_watcher.stop)
+		return docks_watcher
+
+def parse_size(text):
+	"""Convert a size from docker (e.g. 1.5MiB or 0B) to bytes."""
+	match = re.match(r'^\s*([\d.]+)\s*([kKMGT]?i?B)\s*$',text)
+	if not match: raise Exception('cannot parse the size %s'%text)
+	units = dict(BuildProfiler.units,TB=10**12,TiB=2**40)
+	return int(float(match.group(1))*units[match.group(2)])
+
+def cgroup_sample(ident,pid=None):
+	"""
+	Read the counters of a container from its cgroup files, which is much cheaper than asking docker.
+	Returns None when the files are not available (e.g. a remote daemon or an unusual cgroup layout).
+	"""
+	root = '/sys/fs/cgroup'
+	def read(*path):
+		with open(os.path.join(*path)) as fp: return fp.read()
+	try:
+		# cgroup v2 has one folder per container with every controller in it
+		if os.path.isfile(os.path.join(root,'cgroup.controllers')):
+			here = [i for i in [os.path.join(root,'system.slice','docker-%s.scope'%ident),
+				os.path.join(root,'docker',ident)] if os.path.isdir(i)]
+			if not here: return None
+			cpu = dict([i.split() for i in read(here[0],'cpu.stat').splitlines()])
+			sample = dict(cpu_total=int(cpu['usage_usec'])/10.**6,mem=int(read(here[0],'memory.current')))
+			io = [dict([j.split('=') for j in i.split()[1:]]) for i in read(here[0],'io.stat').splitlines()]
+			sample.update(read=sum([int(i.get('rbytes',0)) for i in io]),
+				write=sum([int(i.get('wbytes',0)) for i in io]))
+		else:
+			if not os.path.isdir(os.path.join(root,'cpuacct','docker',ident)): return None
+			sample = dict(cpu_total=int(read(root,'cpuacct','docker',ident,'cpuacct.usage'))/10.**9,
+				mem=int(read(root,'memory','docker',ident,'memory.usage_in_bytes')))
+			io = [i.split() for i in read(root,'blkio','docker',ident,
+				'blkio.throttle.io_service_bytes').splitlines()]
+			sample.update(read=sum([int(i[2]) for i in io if len(i)==3 and i[1]=='Read']),
+				write=sum([int(i[2]) for i in io if len(i)==3 and i[1]=='Write']))
+		# network counters live in the network namespace of the container
+		sample.update(rx=0,tx=0)
+		if pid:
+			for line in read('/proc',str(pid),'net','dev').splitlines()[2:]:
+				device,values = line.split(':',1)
+				if device.strip()=='lo': continue
+				values = values.split()
+				sample['rx'] += int(values[0])
+				sample['tx'] += int(values[8])
+		return sample
+	except (IOError,OSError,KeyError,ValueError): return None
+
+class ResourceSampler(object):
+	"""
+	Sample the CPU, memory, block I/O and network use of a container at an interval until it stops.
+	Rows hold the time, the CPU use in percent of one core, the memory in bytes, and cumulative bytes
+	read, written, received and sent.
+	"""
+	fields = ['t','cpu','mem','read','write','rx','tx']
+	def __init__(self,name,interval=1.0):
+		self.name,self.interval = name,float(interval)
+		self.rows,self.source,self.last = [],None,None
+		self.stopped = threading.Event()
+		self.thread = None
+	def start(self):
+		try: self.detail = docker_backend().inspect(self.name)
+		except DockerError as e:
+			print('[WARNING] cannot sample container %s: %s'%(self.name,e))
+			return self
+		self.start_time = time.time()
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+	def sample(self):
+		sample = None
+		if self.source!='docker': sample = cgroup_sample(self.detail['id'],self.detail.get('pid'))
+		if sample: self.source = 'cgroup'
+		else:
+			self.source = 'docker'
+			sample = docker_backend().stats(self.name)
+		now = time.time()-self.start_time
+		cpu = sample.get('cpu_percent')
+		if cpu==None and self.last:
+			cpu = 100.*(sample['cpu_total']-self.last[1])/max(now-self.last[0],10**-6)
+		self.last = (now,sample.get('cpu_total'))
+		if cpu==None: return
+		self.rows.append([round(now,2),round(cpu,1)]+[int(sample[i]) for i in self.fields[2:]])
+	def run(self):
+		while not self.stopped.is_set():
+			try: self.sample()
+			# the container is gone once it exits
+			except (DockerError,IOError,OSError,KeyError,ValueError): break
+			self.stopped.wait(self.interval)
+	def stop(self,fn=None):
+		"""Stop sampling and write the samples and their summary."""
+		self.stopped.set()
+		if self.thread: self.thread.join()
+		result = dict(name=self.name,interval=self.interval,source=self.source,
+			fields=self.fields,rows=self.rows,summary=self.summary())
+		if fn:
+			with open(fn,'w') as fp: json.dump(result,fp,separators=(',',':'))
+			print('[STATUS] wrote %d resource samples for %s to %s'%(len(self.rows),self.name,fn))
+		return result
+	def summary(self):
+		if not self.rows: return dict(samples=0)
+		columns = dict(zip(self.fields,zip(*self.rows)))
+		mb = 1./2**20
+		return dict(samples=len(self.rows),duration=columns['t'][-1],
+			cpu_peak=max(columns['cpu']),cpu_mean=round(sum(columns['cpu'])/len(self.rows),1),
+			mem_peak_mb=round(max(columns['mem'])*mb,1),
+			mem_mean_mb=round(sum(columns['mem'])*mb/len(self.rows),1),
+			read_mb=round((columns['read'][-1]-columns['read'][0])*mb,1),
+			write_mb=round((columns['write'][-1]-columns['write'][0])*mb,1),
+			rx_mb=round((columns['rx'][-1]-columns['rx'][0])*mb,1),
+			tx_mb=round((columns['tx'][-1]-columns['tx'][0])*mb,1))
+
+def docker_backend():
+	"""
+	Choose the docker backend once per process.
+	Set `docks_backend` in the config or DOCKS_BACKEND to cli, api, or auto (the default).
+	The fake backend never calls docker and is only useful for benchmarks.
+	The API socket comes from DOCKER_HOST when it is a unix socket.
+	"""
+	global docks_backend
+	with docks_lock:
+		if docks_backend: return docks_backend
+		choice = os.environ.get('DOCKS_BACKEND',read_config().get('docks_backend','auto'))
+		host = os.environ.get('DOCKER_HOST','unix:///var/run/docker.sock')
+		socket_fn = host[len('unix://'):] if host.startswith('unix://') else None
+		if choice not in ['cli','api','auto','fake']: raise Exception('invalid docks_backend: %s'%choice)
+		if choice=='api' and not socket_fn: raise Exception('the docker API needs a unix DOCKER_HOST')
+		if choice=='api' or (choice=='auto' and socket_fn and os.access(socket_fn,os.R_OK|os.W_OK)):
+			docks_backend = DockerAPI(socket_fn)
+		elif choice=='fake': docks_backend = DockerFake()
+		else: docks_backend = DockerCLI()
+		return docks_backend
+
+def interpret_docker_cached(config,mods=None):
+	"""
+	Interpret a docker configuration once per process and once per change to the config or mods files.
+	Returns the instructions along with a catalog of tests indexed by their sorted signatures.
+	"""
+	import hashlib
 	if os.path.basename(config)=='config.py':
 		raise Exception('you cannot call the config file "config.py" or we have an import failure')
-	# import_remote wraps exec and discards builtins
-	from makeface import import_remote
 	if not os.path.isfile(config): raise Exception('cannot find %s'%config)
-	mod = import_remote(os.path.join('./',config))
-	instruct = mod['interpreter'](mods=mods)
-	# validators go here
-	return instruct
+	#! the interpreter may read other files which are not part of the hash
+	digest = hashlib.sha1(os.path.abspath(config).encode('utf-8'))
+	for fn in [config,mods]:
+		digest.update((file_digest(fn) if fn and os.path.isfile(fn) else repr(fn)).encode('utf-8'))
+	digest = digest.hexdigest()
+	with docks_lock:
+		if digest in docks_instruct_cache: return docks_instruct_cache[digest]
+		import pickle
+		# one cache file per config path is overwritten whenever the digest changes
+		cache_fn = state_fn('instruct-%s.pickle'%hashlib.sha1(
+			os.path.abspath(config).encode('utf-8')).hexdigest()[:12])
+		cached = None
+		if os.path.isfile(cache_fn):
+			try:
+				with open(cache_fn,'rb') as fp: cached = pickle.load(fp)
+			except Exception: cached = None
+		if not cached or cached.get('digest')!=digest:
+			# import_remote wraps exec and discards builtins
+			import_remote = getattr(config_interface(),'import_remote',None)
+			if not import_remote: from makeface import import_remote
+			mod = import_remote(os.path.join('./',config))
+			instruct = mod['interpreter'](mods=mods)
+			# validators go here
+			catalog = {}
+			for key in instruct.get('tests',{}):
+				catalog.setdefault(tuple(sorted(set(key.split()))),[]).append(key)
+			cached = dict(digest=digest,instruct=instruct,catalog=catalog)
+			try:
+				with open(cache_fn,'wb') as fp: pickle.dump(cached,fp,protocol=2)
+			except Exception as e: 
+				print('[WARNING] cannot cache the docker instructions: %s'%e)
+				if os.path.isfile(cache_fn): os.remove(cache_fn)
+		docks_instruct_cache[digest] = cached
+		return cached
+
+def interpret_docker_instructions(config,mods=None):
+	"""
+	Read a docker configuration for running things in the docker.
+	"""
+	import copy
+	# callers modify the instructions so they always get a copy of the cache
+	return copy.deepcopy(interpret_docker_cached(config,mods=mods)['instruct'])
 
 def docker_list(**kwargs):
 	"""
@@ -47,30 +1189,94 @@ def docker_list(**kwargs):
 	import pprint
 	pprint.pprint(toc,width=110)
 
-def docker(name,config=None,report=None,sequential=False,mods=None,**kwargs):
+def dockerfile_parse(text):
+	"""Split a dockerfile text into instructions with their continuation lines, comments and blank lines."""
+	items,current = [],[]
+	for line in text.splitlines():
+		current.append(line)
+		if line.rstrip().endswith('\\') and not line.lstrip().startswith('#'): continue
+		items.append('\n'.join(current))
+		current = []
+	if current: items.append('\n'.join(current))
+	return items
+
+def dockerfile_coalesce(texts):
 	"""
-	Manage the DOCKER.
+	Merge adjacent RUN instructions in each fragment and drop USER and WORKDIR instructions which change
+	nothing. Merged commands each run in a subshell so that directory changes and variables stay local
+	as they were in separate layers. Fragments stay separate so sequential builds keep their stages.
+	Returns the new texts and the number of filesystem layers before and after.
 	"""
-	build_dn = kwargs.pop('build','builds')
-	toc_fn = kwargs.pop('toc_fn','docker.json')
-	username = kwargs.pop('username',container_user)
-	config_dict = read_config()
-	if config==None: config = config_dict.get('docks_config','docker_config.py')
-	if kwargs: raise Exception('unprocessed kwargs %s'%kwargs)
-	# get the interpreted docker configuration
-	instruct = interpret_docker_instructions(config=config,mods=mods)
-	config = config_dict
+	layer_kinds = ['RUN','COPY','ADD']
+	# a custom shell may not understand subshells
+	merge = not any([re.search(r'^\s*SHELL\s',text,flags=re.M|re.I) for step,text in texts])
+	user,workdir = None,None
+	result,counts = [],dict(before=0,after=0)
+	for step,text in texts:
+		kept = []
+		for item in dockerfile_parse(text):
+			words = item.split(None,1)
+			kind = words[0].upper() if words and not item.lstrip().startswith('#') else None
+			body = words[1].strip() if len(words)>1 else ''
+			if kind in layer_kinds: counts['before'] += 1
+			if kind=='FROM': user,workdir = None,None
+			elif kind=='USER':
+				if body==user: continue
+				# a user which is replaced before anything else happens does nothing
+				if kept and kept[-1][0]=='USER': kept.pop()
+				user = body
+			elif kind=='WORKDIR':
+				if body==workdir: continue
+				workdir = body if body.startswith('/') and '$' not in body else None
+			elif kind=='RUN':
+				mergeable = (merge and not body.startswith('[') and not body.startswith('--')
+					and '#' not in body and '<<' not in body)
+				if mergeable and kept and kept[-1][0]=='RUN' and kept[-1][2]:
+					kept[-1][1].append(body)
+					continue
+				kept.append(('RUN',[body] if mergeable else item,mergeable))
+				continue
+			kept.append((kind,item,False))
+		lines = []
+		for kind,item,mergeable in kept:
+			if kind in layer_kinds: counts['after'] += 1
+			if kind=='RUN' and mergeable:
+				lines.append('RUN '+item[0] if len(item)==1 else
+					'RUN '+' && \\\n\t'.join(['( %s )'%i for i in item]))
+			else: lines.append(item)
+		result.append((step,'\n'.join(lines)+('\n' if text.endswith('\n') else '')))
+	return result,counts
+
+def dockerfile_reorder(texts):
+	"""
+	Move the fragments which changed most often in the build history toward the end of a sequence
+	so that more of the earlier layers stay cached. The first fragment and the user coda stay put.
+	Only use this when the fragments in the middle do not depend on each other.
+	"""
+	changes = {}
+	for record in history_query():
+		for step,blob in record['texts']: changes.setdefault(step,set()).add(blob)
+	fixed = ['su','coda']
+	middle = sorted([i for i in texts[1:] if i[0] not in fixed],key=lambda x:len(changes.get(x[0],[])))
+	return texts[:1]+middle+[i for i in texts[1:] if i[0] in fixed]
+
+def docker_prepare(name,instruct,config,coalesce=False,reorder=False):
+	"""
+	Prepare the dockerfile texts and the staged files for one sequence.
+	Optionally reorder the fragments by how often they change and coalesce their layers.
+	"""
+	import pwd,grp
 	# the name is a sequence
 	if name not in instruct.get('sequences',{}): 
 		raise Exception('docker configuration lacks a sequence called %s'%name)
 	seqspec = instruct['sequences'][name]
-	# prepare a build directory
-	if os.path.isdir(build_dn): shutil.rmtree(build_dn)
-	os.mkdir(build_dn)
-	# get the docker history
-	docker_history = config.get('docker_history',{})
+	# we allow the sequence to be a dictionary (extra features) or a string (default)
+	if type(seqspec) in str_types: seqspec = {'seq':seqspec}
+	# requirements modify a copy of the dockerfiles so that we can prepare many sequences
+	dockerfiles = dict(instruct['dockerfiles'])
 	# process all requirements before making the texts
 	reqs = instruct.get('requirements',{})
+	staged,staged_steps = [],{}
 	for key,val in reqs.items():
 		# only check the requirement if the key points to an item in the sequence
 		if key not in seqspec.get('seq','').split(): continue
@@ -86,16 +1292,14 @@ def docker(name,config=None,report=None,sequential=False,mods=None,**kwargs):
 				raise Exception('failed to get item %s from the config dictionary.'%str(key_path))
 			spot = config[key_path[0]]
 			# substitute in the dockerfile
-			if key not in instruct['dockerfiles']: raise Exception('cannot find %s in dockerfiles'%key)
-			instruct['dockerfiles'][key] = re.sub(val['filename_sub'],
-				os.path.basename(spot),instruct['dockerfiles'][key])
+			if key not in dockerfiles: raise Exception('cannot find %s in dockerfiles'%key)
+			dockerfiles[key] = re.sub(val['filename_sub'],os.path.basename(spot),dockerfiles[key])
 			for sub_from,sub_to in val.get('subs',{}).items():
-				instruct['dockerfiles'][key] = re.sub(sub_from,sub_to,instruct['dockerfiles'][key])
-			# we always have to copy the file to the docker build directory
-			shutil.copyfile(spot,os.path.join(build_dn,os.path.basename(spot)))
+				dockerfiles[key] = re.sub(sub_from,sub_to,dockerfiles[key])
+			# the file is always staged in the docker build directory
+			staged.append(spot)
+			staged_steps.setdefault(key,[]).append(spot)
 		else: raise Exception('cannot get requirement for %s: %s'%(key,val))
-	# we allow the sequence to be a dictionary (extra features) or a string (default)
-	if type(seqspec) in str_types: seqspec = {'seq':seqspec}
 	# defaults and extra settings passed through a sequence dictionary
 	seq = seqspec['seq']
 	user_coda = seqspec.get('user',False)
@@ -103,26 +1307,17 @@ def docker(name,config=None,report=None,sequential=False,mods=None,**kwargs):
 	if coda!=None and user_coda==False: raise Exception('cannot allow a coda if not user')
 	# prepare the texts of the dockerfiles
 	steps = seq.split()
-	texts = [(step,instruct['dockerfiles'][step]) for step in steps]
+	texts = [(step,dockerfiles[step]) for step in steps]
 	# final stage adds the user
 	this_user = pwd.getpwnam(os.environ['USER'])
 	this_user_details = {'gid':this_user.pw_gid,'uid':this_user.pw_uid,'user':os.environ['USER']}
 	this_user_details.update(gname=grp.getgrgid(this_user_details['gid']).gr_name)
-	# handle special keys
-	special_keys = {'@USER'}
-	for ii,(step,text) in enumerate(texts):
-		# handle config calls with some hardcoded items
-		special_keys_this = set(re.findall('@[\w_]+',texts[ii][1])).intersection(special_keys)
-		for key in special_keys_this: 
-			if key=='@USER': 
-				texts[ii] = (step,re.sub('@USER',this_user_details['user'],texts[ii][1]))
-			else: raise Exception
-	# substitutions of @read_config('<key>') from the config
-	for ii,(step,text) in enumerate(texts):
-		comp = re.compile(r'@read_config\((.*?)\)',flags=re.M)
-		for config_key in comp.findall(texts[ii][1]):
-			val = config.get(eval(config_key))
-			texts[ii] = (step,re.sub('@read_config\(%s\)'%config_key,val,texts[ii][1]))
+	# substitutions of @USER and @read_config(<key>) from the config
+	def read_config_key(key):
+		if key not in config: raise Exception('cannot find %s in the config for @read_config'%key)
+		return config[key]
+	texts = template_render(texts,names={'USER':this_user_details['user']},
+		calls={'read_config':read_config_key})
 	# at the end of each run we set the user so that permissions work properly and dockers are run as user
 	if user_coda:
 		this_user_details['user_passwd'] = config.get('user_creds')
@@ -138,103 +1333,313 @@ def docker(name,config=None,report=None,sequential=False,mods=None,**kwargs):
 	docker_details = dict(user_coda=user_coda)
 	# commands to run after setting the user
 	if coda!=None: texts += [('coda',coda)]
+	if reorder: texts = dockerfile_reorder(texts)
+	layers = None
+	if coalesce: texts,layers = dockerfile_coalesce(texts)
+	return dict(texts=texts,details=docker_details,staged=staged,staged_steps=staged_steps,layers=layers)
+
+def docker(name,config=None,report=None,sequential=False,mods=None,**kwargs):
+	"""
+	Manage the DOCKER.
+	Use `coalesce=True` (or `docks_coalesce` in the config) to merge layers and `reorder=True` to move
+	the fragments which change most often to the end. The report includes the layer savings.
+	"""
+	build_dn = kwargs.pop('build','builds')
+	toc_fn = kwargs.pop('toc_fn','docker.json')
+	username = kwargs.pop('username',container_user)
+	config_dict = read_config()
+	if config==None: config = config_dict.get('docks_config','docker_config.py')
+	coalesce = kwargs.pop('coalesce',config_dict.get('docks_coalesce',False))
+	reorder = kwargs.pop('reorder',config_dict.get('docks_reorder',False))
+	if kwargs: raise Exception('unprocessed kwargs %s'%kwargs)
+	# get the interpreted docker configuration
+	instruct = interpret_docker_instructions(config=config,mods=mods)
+	config = config_dict
+	history_migrate()
+	prepped = docker_prepare(name,instruct,config,coalesce=coalesce,reorder=reorder)
+	texts,docker_details = prepped['texts'],prepped['details']
+	staged,staged_steps = prepped['staged'],prepped['staged_steps']
+	summary = []
+	if prepped['layers']:
+		summary.append('coalesced %(before)d layers into %(after)d'%prepped['layers'])
+		sizes = docker_sizes(name)
+		if sizes.get(True) and sizes.get(False):
+			summary.append('the latest image is %.1f MB with coalescing and %.1f MB without'%(
+				sizes[True]/10.**6,sizes[False]/10.**6))
+		for line in summary: print('[STATUS] %s'%line)
+	# prepare a build directory with only the staged files (stale files would bloat the context)
+	stage_sync(dict([(os.path.basename(i),i) for i in staged]),build_dn,prune=True)
 	# if we are reporting then write the file and exit
 	if report!=None:
 		with open(report,'w') as fp:
+			fp.write(''.join(['# docks: %s\n'%i for i in summary]))
 			fp.write('\n'.join(list(zip(*texts))[1]))
 		return docker_details
 	# never rebuild if unnecessary (docker builds are extremely quick but why waste the time)
 	# we use the texts of the docker instead of timestamps, since users might be updating other parts 
-	# ... of the config file pretty frequently
-	if docker_history.keys():
-		keys = sorted([i for i in docker_history.keys() if i[0]==name])
-		if keys:
-			if docker_history[keys[-1]]['texts']==texts:
-				print(('[STATUS] the docker called "%s" has already been built '+
-					'and the instructions have not changed')%name)
-				return docker_details
-	# record the history for docker_history
+	# ... of the config file pretty frequently. the digest also covers the contents of staged files
+	# ... and is indexed by image name so we never have to search the history
+	digest = docker_digest(texts,staged)
+	if history_latest(name).get('digest')==digest:
+		print(('[STATUS] the docker called "%s" has already been built '+
+			'and the instructions have not changed')%name)
+		return docker_details
+	# record the history for the history store
 	updates,total_time = [],0.0
 	# in the sequential method we generate larger dockerfiles from small ones so that adding
 	# ... to the end of a long dockerfile resumes at the previous image. since the sequential dockerfiles 
 	# ... are always built in the same way, this saves time
 	#! the sequential feature and the text checking feature is highly redundant with docker
-	#! note clean cluttered images with `docker rmi $(docker images | awk '$1 ~ /-s/ {print $3}')`
+	#! note clean cluttered images with `make docker_gc` or set docks_gc in the config
 	if sequential:
+		# resume at the first stage whose prefix changed or whose image is missing
+		image_names = ['%s-s%d'%(name,stage) for stage in range(len(texts)-1)]+[name]
+		fingerprints = stage_fingerprints(texts,staged_steps)
+		stages_built = history_latest(name).get('stages',{})
+		resume = 0
+		# the final image is never skipped since we only get here when the digest in the index differs
+		while (resume<len(texts)-1 and stages_built.get(image_names[resume])==fingerprints[resume] and
+			docker_backend().image_exists('%s/%s'%(username,image_names[resume]))): resume += 1
+		if resume>0: print('[STATUS] skipping %d unchanged stages of %s'%(resume,name))
 		# loop over stages, each of which gets a separate image
 		for stage,(stage_name,text) in enumerate(texts):
-			start_time = time.time()
+			image_name = image_names[stage]
+			if stage<resume:
+				updates.append(dict(name=stage_name,image=image_name,elapsed=0.0,skipped=True))
+				continue
 			# prepare names
 			print('[STATUS] processing %s, stage %d: %s'%(name,stage,stage_name))
 			# subsequent stages depend on the previous one so we prepend it
-			if stage>0: text = 'FROM %s/%s\n'%(username,image_name)+text
-			image_name = '%s-s%d'%(name,stage)
-			if stage==len(texts)-1: image_name = name
+			if stage>0: text = 'FROM %s/%s\n'%(username,image_names[stage-1])+text
 			print('[STATUS] image name: %s'%image_name)
 			print('\n'.join(['[CONFIG] | %s'%i for i in text.splitlines()]))
-			docker_fn = os.path.join(build_dn,'Dockerfile-%s'%image_name)
-			# write the docker file
-			with open(docker_fn,'w') as fp: fp.write(text)
-			# generate the image
-			cmd = 'docker build -t %s/%s -f %s %s'%(
-				username,image_name,docker_fn,
-				os.path.join(build_dn,''))
-			print('[STATUS] running "%s"'%cmd)
-			subprocess.check_call(cmd,shell=True)
-			elapsed_sec = time.time() - start_time
-			total_time += elapsed_sec
-			elapsed = '%.1f min'%(elapsed_sec/60.)
-			print('[TIME] elapsed: %s'%elapsed)
-			updates.append(dict(name=stage_name,image=image_name,elapsed=elapsed_sec))
+			update = docker_build_image(username,image_name,text,build_dn)
+			total_time += update['elapsed']
+			updates.append(dict(update,name=stage_name))
+			# record each stage as it completes so that a failure resumes from here
+			stages_built[image_name] = fingerprints[stage]
+			history_index({name:dict(stages=stages_built)})
 	# standard, non-sequential method
 	else:
-		start_time = time.time()
-		image_name = name
+		history_forget_stage([name])
 		text = '\n'.join(list(zip(*texts))[1])
-		docker_fn = os.path.join(build_dn,'Dockerfile-%s'%name)
-		# write the docker file
-		with open(docker_fn,'w') as fp: fp.write(text)
-		cmd = 'docker build -t %s/%s -f %s %s'%(
-			username,image_name,docker_fn,
-			os.path.join(build_dn,''))
-		print('[STATUS] running "%s"'%cmd)
-		subprocess.check_call(cmd,shell=True)
-		elapsed_sec = time.time() - start_time
-		total_time += elapsed_sec
-		elapsed = '%.1f min'%(elapsed_sec/60.)
-		print('[TIME] elapsed: %s'%elapsed)
-		updates.append(dict(name='everything',image=image_name,elapsed=elapsed_sec))
+		update = docker_build_image(username,name,text,build_dn)
+		total_time += update['elapsed']
+		updates.append(dict(update,name='everything'))
 	# save to the history with a docker style in contrast to a test style
 	# since we only save at the end, a failure means no times get written
-	ts = datetime.datetime.fromtimestamp(time.time()).strftime('%Y.%m.%d.%H%M')
-	docker_history[(name,ts)] = dict(series=updates,texts=texts,total_time=total_time)
-	config.update(docker_history=docker_history)
-	write_config(config)
+	ts = time.strftime('%Y.%m.%d.%H%M')
+	history_append(name,ts,dict(series=updates,texts=texts,total_time=total_time,digest=digest,
+		coalesce=bool(coalesce),size=updates[-1].get('size')),keep=config.get('docks_history_keep',50))
+	docker_gc_hook(config)
 	return docker_details
 
+def docker_all(config=None,mods=None,names=None,workers=2,**kwargs):
+	"""
+	Build every sequence at once.
+	Sequences are merged into a tree of their dockerfile steps so that each shared prefix is built once
+	as an intermediate image and independent branches are built in parallel (e.g. `workers=4`).
+	Each image is built from its own context in the build folder with only the requirements of its steps.
+	Select sequences with e.g. `names=one,two`.
+	"""
+	import shutil
+	from multiprocessing.pool import ThreadPool
+	build_dn = kwargs.pop('build','builds')
+	username = kwargs.pop('username',container_user)
+	config_dict = read_config()
+	if config==None: config = config_dict.get('docks_config','docker_config.py')
+	if kwargs: raise Exception('unprocessed kwargs %s'%kwargs)
+	# get the interpreted docker configuration
+	instruct = interpret_docker_instructions(config=config,mods=mods)
+	config = config_dict
+	history_migrate()
+	if names==None: names = sorted(instruct.get('sequences',{}).keys())
+	elif type(names) in str_types: names = names.split(',')
+	prepped = dict([(name,docker_prepare(name,instruct,config,coalesce=config.get('docks_coalesce',False),
+		reorder=config.get('docks_reorder',False))) for name in names])
+	# merge the sequences into a tree keyed by dockerfile steps
+	root = dict(children={},names=[],parent=None)
+	building = []
+	for name in names:
+		texts = prepped[name]['texts']
+		prepped[name]['digest'] = docker_digest(texts,prepped[name]['staged'])
+		if (history_latest(name).get('digest')==prepped[name]['digest'] and
+			docker_backend().image_exists('%s/%s'%(username,name))):
+			print('[STATUS] the docker called "%s" has already been built'%name)
+			continue
+		building.append(name)
+		node = root
+		fingerprints = stage_fingerprints(texts,prepped[name]['staged_steps'])
+		for (step,text),fingerprint in zip(texts,fingerprints):
+			node = node['children'].setdefault((step,text),dict(children={},names=[],
+				step=step,text=text,fingerprint=fingerprint,parent=node,
+				staged=prepped[name]['staged_steps'].get(step,[])))
+		node['names'].append(name)
+	history_forget_stage(building)
+	# images are made at the end of each sequence and wherever sequences diverge
+	is_image = lambda node: node is not root and (node['names'] or len(node['children'])!=1)
+	image_of = lambda node: (node['names'][0] if node['names']
+		else 'docks-prefix-%s'%node['fingerprint'][:12])
+	def image_children(node):
+		for child in node['children'].values():
+			if is_image(child): yield child
+			else:
+				for grandchild in image_children(child): yield grandchild
+	def segment_of(node):
+		"""Get the steps between an image and the image it starts from."""
+		segment,parent = [],node
+		while True:
+			segment.insert(0,parent)
+			parent = parent['parent']
+			if parent is root or is_image(parent): return segment,parent
+	def image_nodes(node):
+		for child in image_children(node):
+			yield child
+			for grandchild in image_nodes(child): yield grandchild
+	# each image gets a context with only the requirements of its own steps
+	contexts = {}
+	for node in image_nodes(root):
+		sources = contexts.setdefault(image_of(node),{})
+		for fn in [fn for i in segment_of(node)[0] for fn in i['staged']]:
+			if sources.get(os.path.basename(fn),fn)!=fn:
+				raise Exception('two requirements are both called %s'%os.path.basename(fn))
+			sources[os.path.basename(fn)] = fn
+	if not os.path.isdir(build_dn): os.makedirs(build_dn)
+	for fn in os.listdir(build_dn):
+		if fn in contexts: continue
+		path = os.path.join(build_dn,fn)
+		if os.path.isdir(path) and not os.path.islink(path): shutil.rmtree(path)
+		else: os.remove(path)
+	for image_name,sources in contexts.items(): stage_sync(sources,os.path.join(build_dn,image_name),prune=True)
+	def build_node(node):
+		segment,parent = segment_of(node)
+		segment = [(i['step'],i['text']) for i in segment]
+		text = '\n'.join([i[1] for i in segment])
+		if parent is not root: text = 'FROM %s/%s\n'%(username,image_of(parent))+text
+		image_name = image_of(node)
+		context_dn = os.path.join(build_dn,image_name)
+		label = ' '.join([i[0] for i in segment])
+		# intermediate images are named by their fingerprint so an existing one is current
+		if not node['names'] and docker_backend().image_exists('%s/%s'%(username,image_name)):
+			print('[STATUS] found the shared image %s for: %s'%(image_name,label))
+			return dict(image=image_name,elapsed=0.0,skipped=True,name=label)
+		print('[STATUS] building %s from: %s'%(image_name,label))
+		update = docker_build_image(username,image_name,text,context_dn)
+		for other in node['names'][1:]: docker_build_image(username,other,text,context_dn)
+		return dict(update,name=label)
+	# build each image as soon as its parent is ready
+	pool = ThreadPool(int(workers))
+	results,failed = {},[]
+	# the root counts as pending until every top-level image is submitted
+	state = dict(pending=1)
+	state_lock,finished = threading.Lock(),threading.Event()
+	def submit(node):
+		with state_lock: state['pending'] += 1
+		pool.apply_async(run,(node,))
+	def release():
+		with state_lock:
+			state['pending'] -= 1
+			if state['pending']==0: finished.set()
+	def run(node):
+		try:
+			results[id(node)] = build_node(node)
+			for child in image_children(node): submit(child)
+		except Exception as e:
+			print('[WARNING] failed to build %s: %s'%(image_of(node),e))
+			failed.append(image_of(node))
+		finally: release()
+	for child in image_children(root): submit(child)
+	release()
+	finished.wait()
+	pool.close()
+	pool.join()
+	# record each sequence in the history along with the chain of images which made it
+	ts = time.strftime('%Y.%m.%d.%H%M')
+	def record(node,chain):
+		if node is not root and is_image(node): chain = chain+[node]
+		for name in node['names']:
+			if not all([id(i) in results for i in chain]): continue
+			updates = [results[id(i)] for i in chain]
+			history_append(name,ts,dict(series=updates,texts=prepped[name]['texts'],
+				total_time=sum([i['elapsed'] for i in updates]),digest=prepped[name]['digest']),
+				keep=config.get('docks_history_keep',50))
+		for child in node['children'].values(): record(child,chain)
+	record(root,[])
+	built = [i for i in results.values() if not i.get('skipped')]
+	print('[STATUS] built %d images for %d sequences'%(len(built),len(names)))
+	if built: docker_gc_hook(config)
+	if failed: raise Exception('failed to build: %s'%', '.join(failed))
+
+def docker_build_image(username,image_name,text,build_dn):
+	"""
+	Build one image from a dockerfile text and profile each instruction.
+	"""
+	start_time = time.time()
+	docker_fn = os.path.join(build_dn,'Dockerfile-%s'%image_name)
+	# write the docker file
+	with open(docker_fn,'w') as fp: fp.write(text)
+	# generate the image
+	profiler = BuildProfiler()
+	docker_backend().build('%s/%s'%(username,image_name),docker_fn,build_dn,on_line=profiler.feed)
+	elapsed_sec = time.time() - start_time
+	profile = profiler.record()
+	print('[TIME] elapsed: %.1f min with %d of %d steps cached'%(
+		elapsed_sec/60.,profile['cache_hits'],profile['cache_total']))
+	# the size shows the effect of coalescing layers
+	tag = '%s/%s'%(username,image_name)
+	size = ([i['size'] for i in docker_backend().images() if i['tag'].split(':')[0]==tag] or [None])[0]
+	return dict(image=image_name,elapsed=elapsed_sec,profile=profile,size=size)
+
+def docker_sizes(name):
+	"""Get the image size from the latest build of a sequence with and without coalescing."""
+	sizes = {}
+	for record in history_query(name=name):
+		if record.get('size'): sizes[bool(record.get('coalesce'))] = record['size']
+	return sizes
+
 def test(*sigs,**kwargs):
 	"""
 	Run a testset in a docker.
+	Use `warm=True` (or `docks_warm` in the config) to run the script in a reusable container.
+	Use `stats=1` (or `docks_stats` in the config) to sample resources every second into the logs.
 	"""
+	import shutil
 	collect_log = kwargs.pop('log',False)
 	do_wait = kwargs.pop('wait',False)
+	warm = kwargs.pop('warm',None)
+	stats = kwargs.pop('stats',None)
 	prepped = test_run(*sigs,**kwargs)
 	container_name = '_'.join(sigs)
 	prepped['container_name'] = container_name
 	prepped['wait'] = do_wait
+	if warm!=None: prepped['warm'] = warm
+	if stats!=None: prepped['stats'] = stats
+	# CUSTOM STRUCTURE FOR RECORDING TESTS
+	log_fn = 'logs/%s.log'%(container_name)
+	if collect_log and do_wait:
+		# parallel tests may race to make the folder
+		try: os.mkdir('logs')
+		except OSError:
+			if not os.path.isdir('logs'): raise
+		# detached containers stream their logs while they run
+		prepped['log_fn'] = log_fn
 	respond = docker_execute_local(**prepped)
+	# tests which run once return nothing when they are skipped
+	if respond==None: return
 	# manage proof of work for a completed test here
 	#! options for storing proof are: in config (possibly testset_history) or custom
 	if collect_log and do_wait:
-		# CUSTOM STRUCTURE FOR RECORDING TESTS
-		if not os.path.isdir('logs'): os.mkdir('logs')
-		# get the docker log
-		try: 
-			#! replace with check_call
-			log_fn = 'logs/%s.log'%(container_name)
-			os.system('docker logs %s &> %s'%(container_name,log_fn))
-			print('[STATUS] wrote docker logs for %s to %s'%(container_name,log_fn))
-		except: print('[WARNING] failed to collect logs for container %s'%container_name)
+		# get the docker log if it was not streamed
+		if 'log' not in respond:
+			try: respond['log'] = container_log_stream(container_name,log_fn)
+			except Exception as e: 
+				print('[WARNING] failed to collect logs for container %s: %s'%(container_name,e))
+		if 'log' in respond: print('[STATUS] wrote docker logs for %s to %s'%(container_name,log_fn))
+		# record the completion marker next to the log for the megatest report
+		respond['complete'] = respond.get('log',{}).get('complete',False)
+		with open(re.sub(r'\.log$','',log_fn)+'.complete.json','w') as fp:
+			json.dump(dict(complete=respond['complete'],exit_code=respond.get('exit_code'),
+				elapsed=respond.get('log',{}).get('elapsed')),fp)
 		# get the script
 		script_fn = os.path.join(respond['spot'],respond['script'])
 		if not os.path.isfile(script_fn):
@@ -244,14 +1649,20 @@ def test(*sigs,**kwargs):
 			shutil.move(script_fn,script_out)
 			print('[STATUS] moved script to %s'%script_out)
 	#! remove the container if we waited for it now that we should have logs
-	if do_wait:
+	if do_wait and not respond.get('warm') and not respond.get('removed'):
 		try:
 			print('[STATUS] clearing container') 
-			os.system('docker rm %s'%container_name)
+			docker_backend().remove(container_name)
 		except: print('[WARNING] failed to remove container %s'%container_name)
+	# fail like an attached run, which raises as soon as the container exits
+	if respond.get('exit_code',0)!=0:
+		raise DockerError('test %s exited with code %s'%(container_name,respond['exit_code']),
+			status=respond['exit_code'])
+	return respond
 
 def test_run(*sigs,**kwargs):
 	"""Prepare the test for running or reporting."""
+	import copy
 	build_dn = kwargs.pop('build','docker_builds')
 	username = kwargs.pop('username',container_user)
 	config_fn = kwargs.pop('config',None)
@@ -262,13 +1673,14 @@ def test_run(*sigs,**kwargs):
 	dump_raw_test = kwargs.pop('dump_raw_test',None)
 	if kwargs: raise Exception('unprocessed kwargs %s'%kwargs)
 	# get the interpreted docker configuration
-	instruct = interpret_docker_instructions(config=config_fn,mods=mods_fn)
-	# use the sigs list to select a test set
-	tests = instruct.get('tests',{})
-	keys = [key for key in tests if set(sigs)==set(key.split())]
+	cached = interpret_docker_cached(config=config_fn,mods=mods_fn)
+	# use the sigs list to select a test set from the catalog
+	keys = cached['catalog'].get(tuple(sorted(set(sigs))),[])
 	if len(keys)!=1: 
-		raise Exception('cannot find a unique key in the testset for sigs %s: %s'%(sigs,tests.keys()))
+		raise Exception('cannot find a unique key in the testset for sigs %s: %s'%(
+			sigs,list(cached['instruct'].get('tests',{}).keys())))
 	else: name = keys[0]
+	tests = {name:copy.deepcopy(cached['instruct']['tests'][name])}
 	if dump_raw_test:
 		import yaml
 		with open(dump_raw_test,'w') as fp:
@@ -282,9 +1694,10 @@ def docker_execute_local(**kwargs):
 	# check keys here
 	keys_docker_local = ('docker','where','script','config_fn')
 	keys_docker_local_visit = ('docker','where','visit','config_fn')
-	keys_docker_local_opts = ('once','preliminary','collect files','report files',
+	keys_docker_local_opts = ('once','preliminary','preliminary inputs','preliminary outputs',
+		'collect files','report files',
 		'notes','mounts','container_user','container_site','visit','ports','background',
-		'write files','container_name','wait')
+		'write files','container_name','wait','log_fn','warm','stats')
 	keysets = {
 		(keys_docker_local,keys_docker_local_opts):'docker_local',
 		(keys_docker_local_visit,keys_docker_local_opts):'docker_local',}
@@ -299,20 +1712,183 @@ def docker_execute_local(**kwargs):
 	if choices[0]=='docker_local': return docker_local(**kwargs)
 	else: raise Exception(fail)
 
+def event_fingerprint(event):
+	"""Hash a testset event in a canonical form."""
+	import hashlib
+	return hashlib.sha1(json.dumps(event,sort_keys=True,default=repr).encode('utf-8')).hexdigest()
+
+def container_log_stream(container_name,log_fn,marker='unit test is complete',chunk=2**16,blocks=None):
+	"""
+	Follow the output of a container into a log file until the container exits.
+	Memory use is bounded by the chunk size and the completion marker is reported when it appears.
+	Pass `blocks` to follow another source of output, for example a command run in a warm container.
+	"""
+	marker = marker.encode('utf-8')
+	tail,detail = b'',dict(complete=False,size=0)
+	start_time = time.time()
+	with open(log_fn,'wb') as fp:
+		if blocks==None: blocks = docker_backend().logs(container_name,follow=True,chunk=chunk)
+		for block in blocks:
+			fp.write(block)
+			fp.flush()
+			detail['size'] += len(block)
+			# keep enough of the previous block to catch a marker split across reads
+			if not detail['complete'] and marker in tail+block:
+				detail.update(complete=True,elapsed=time.time()-start_time)
+				print('[STATUS] container %s reports that the unit test is complete'%container_name)
+			tail = (tail+block)[-len(marker):]
+	return detail
+
+def warm_state(state=None):
+	"""Read or write the warm containers in the state folder."""
+	fn = state_fn('warm.json')
+	with docks_lock:
+		if state!=None:
+			with open(fn+'.tmp','w') as fp: json.dump(state,fp)
+			os.rename(fn+'.tmp',fn)
+		elif os.path.isfile(fn):
+			with open(fn) as fp: state = json.load(fp)
+		return state or {}
+
+def warm_retire(name,state):
+	"""Remove a warm container and forget it."""
+	print('[STATUS] retiring the warm container %s after %d runs'%(name,state[name]['runs']))
+	try: docker_backend().remove(name)
+	except DockerError as e: print('[WARNING] failed to remove %s: %s'%(name,e))
+	del state[name]
+
+def warm_acquire(run_spec,runs,idle):
+	"""
+	Get a warm container with the same image, user, mounts and ports as a run, starting one if needed.
+	Containers are retired after a number of runs or when they sit idle for too long.
+	The key includes the image ID so that a rebuilt image never runs in a container from the old one.
+	"""
+	import hashlib
+	image_id = docker_backend().image_id(run_spec['image'])
+	key = hashlib.sha1(json.dumps([run_spec['image'],image_id,run_spec['user'],
+		sorted([list(i) for i in run_spec.get('volumes',[])]),
+		sorted([list(i) for i in run_spec.get('ports',[])])]).encode('utf-8')).hexdigest()[:12]
+	with docks_lock:
+		state,now = warm_state(),time.time()
+		for name in list(state.keys()):
+			if docks_warm_busy.get(name): continue
+			# containers from an image which was rebuilt since they started are stale
+			stale = state[name]['image']==run_spec['image'] and state[name].get('image_id')!=image_id
+			if stale or now-state[name]['last_used']>idle or state[name]['runs']>=runs: warm_retire(name,state)
+		found = [name for name,item in state.items() if item['key']==key and item['runs']<runs]
+		for name in found:
+			if docker_backend().running(name): break
+			# containers which stopped or were removed outside of docks are forgotten
+			if not docks_warm_busy.get(name): warm_retire(name,state)
+		else:
+			name = 'docks-warm-%s-%x'%(key,int(now*10**6))
+			print('[STATUS] starting the warm container %s'%name)
+			# the container idles until we exec into it
+			docker_backend().run(dict(run_spec,name=name,detach=True,command=['tail','-f','/dev/null']))
+			state[name] = dict(key=key,image=run_spec['image'],image_id=image_id,runs=0,started=now)
+		state[name].update(runs=state[name]['runs']+1,last_used=now)
+		docks_warm_busy[name] = docks_warm_busy.get(name,0)+1
+		warm_state(state)
+	return name
+
+def warm_release(name,runs):
+	"""Return a warm container to the pool and retire it if it has used up its runs."""
+	with docks_lock:
+		docks_warm_busy[name] -= 1
+		state = warm_state()
+		if name not in state: return
+		state[name]['last_used'] = time.time()
+		if state[name]['runs']>=runs and not docks_warm_busy[name]: warm_retire(name,state)
+		warm_state(state)
+
+def preliminary_files(paths):
+	"""Expand the declared inputs or outputs of a preliminary script into files. Folders are walked."""
+	import glob
+	if type(paths) in str_types: paths = paths.split()
+	found = {}
+	for path in paths:
+		matches = glob.glob(os.path.expanduser(path))
+		if not matches: found[path] = None
+		for match in matches:
+			if not os.path.isdir(match): found[os.path.abspath(match)] = match
+			else:
+				for root,dns,fns in os.walk(match):
+					for fn in fns: found[os.path.abspath(os.path.join(root,fn))] = os.path.join(root,fn)
+	return found
+
+def preliminary_fingerprint(script,inputs,outputs,known):
+	"""
+	Hash a preliminary script with the contents of its inputs and outputs.
+	Files with the same size and modification time as the last run reuse the digest from that run.
+	Returns None if an output is missing.
+	"""
+	import hashlib
+	digest,files = hashlib.sha1(script.encode('utf-8')),{}
+	for kind,paths in [('inputs',inputs),('outputs',outputs)]:
+		digest.update(('%s\n'%kind).encode('utf-8'))
+		for fn,path in sorted(preliminary_files(paths).items()):
+			if path==None:
+				if kind=='outputs': return None
+				digest.update(('%s missing\n'%fn).encode('utf-8'))
+				continue
+			stat = os.stat(path)
+			stamp = [stat.st_size,stat.st_mtime]
+			if known.get(fn,{}).get('stamp')==stamp: files[fn] = known[fn]
+			else: files[fn] = dict(stamp=stamp,digest=file_digest(path))
+			digest.update(('%s %s\n'%(fn,files[fn]['digest'])).encode('utf-8'))
+	return dict(fingerprint=digest.hexdigest(),files=files)
+
+def preliminary_run(script,inputs=None,outputs=None):
+	"""
+	Run a preliminary script on the host. When the script declares its inputs or outputs, it is skipped
+	if the script text, the inputs and the outputs match the last successful run.
+	"""
+	import subprocess,tempfile,hashlib
+	memo = inputs!=None or outputs!=None
+	if memo:
+		key = hashlib.sha1(json.dumps([script,inputs,outputs]).encode('utf-8')).hexdigest()
+		fn = state_fn('preliminary.json')
+		with docks_lock:
+			state = {}
+			if os.path.isfile(fn):
+				with open(fn) as fp: state = json.load(fp)
+		last = state.get(key,{})
+		current = preliminary_fingerprint(script,inputs or [],outputs or [],last.get('files',{}))
+		if current and current['fingerprint']==last.get('fingerprint'):
+			print('[STATUS] skipping the preliminary script because its inputs and outputs are unchanged')
+			return False
+	script_fn = tempfile.NamedTemporaryFile(delete=True)
+	script_header = '#!/bin/bash\nset -e\n\n'
+	with open(script_fn.name,'w') as fp: fp.write(script_header+script)
+	subprocess.check_call('bash %s'%fp.name,shell=True)
+	if memo:
+		# record the run only after it succeeds and with the outputs it made
+		current = preliminary_fingerprint(script,inputs or [],outputs or [],
+			(current or last).get('files',{}))
+		if current==None: print('[WARNING] the preliminary script did not make all of its outputs')
+		else:
+			with docks_lock:
+				state = {}
+				if os.path.isfile(fn):
+					with open(fn) as fp: state = json.load(fp)
+				state[key] = dict(current,ts=time.strftime('%Y.%m.%d.%H%M'))
+				with open(fn+'.tmp','w') as fp: json.dump(state,fp)
+				os.rename(fn+'.tmp',fn)
+	return True
+
 def docker_local(**kwargs):
 	"""
 	Use a prepared docker to run some code.
 	"""
+	import copy
 	config_fn = kwargs.pop('config_fn','docker_config.py')
 	mods_fn = kwargs.pop('mods_fn',None)
-	# get the docker history
 	config = read_config()
-	docker_history = config.get('docker_history',{})
-	testset_history = config.get('testset_history',{})
+	history_migrate()
 	# check if the docker is ready
 	docker_name = kwargs.get('docker')
 	# call docker which only builds if the docker is not stored in the history
-	docker_details = docker(name=docker_name,config=config_fn,mods=mods_fn)
+	with docks_lock: docker_details = docker(name=docker_name,config=config_fn,mods=mods_fn)
 	# check for once
 	do_once = kwargs.get('once',False)
 	# check for an identical event in the testset history
@@ -325,8 +1901,12 @@ def docker_local(**kwargs):
 		"""
 		kwargs_no_notes = copy.deepcopy(kwargs)
 		kwargs_no_notes.pop('notes',None)
-		events = testset_history.get('events',[])
-		if any([i==kwargs_no_notes for i in events]): 
+		# the log destination and the container reuse do not change the test
+		kwargs_no_notes.pop('log_fn',None)
+		kwargs_no_notes.pop('warm',None)
+		kwargs_no_notes.pop('stats',None)
+		fingerprint = event_fingerprint(kwargs_no_notes)
+		if history_event_done(fingerprint): 
 			print('[STATUS] found an exact match for this test so we are exiting')
 			return
 	# check that the location is ready
@@ -336,24 +1916,19 @@ def docker_local(**kwargs):
 		except Exception as e: 
 			raise Exception('exception is: %s. you might need to mkdir. we failed to make %s'%(e,spot))
 	else: print('[STATUS] found %s'%spot)
-	# run the custom requirements script
+	# run the custom requirements script unless its declared inputs and outputs are unchanged
 	if 'preliminary' in kwargs:
-		import tempfile
-		script = tempfile.NamedTemporaryFile(delete=True)
-		script_header = '#!/bin/bash\nset -e\n\n'
-		with open(script.name,'w') as fp: fp.write(script_header+kwargs['preliminary'])
-		subprocess.check_call('bash %s'%fp.name,shell=True)
+		preliminary_run(kwargs['preliminary'],
+			inputs=kwargs.get('preliminary inputs'),outputs=kwargs.get('preliminary outputs'))
 	# you can embed some files directly in the YAML (this is useful for files that change ports)
-	write_files = kwargs.get('write files',{})
-	if write_files:
-		for fn,text in write_files.items():
-			with open(os.path.join(os.path.dirname(config['docks_config']),fn),'w') as fp: fp.write(text)
-	# collect local files
-	for key,val in kwargs.get('collect files',{}).items():
-		shutil.copyfile(os.path.join(os.path.dirname(config_fn),key),os.path.join(spot,val))
+	write_files_local(kwargs.get('write files',{}),config_fn)
+	# collect local files. the container may write to these so we never hardlink them
+	stage_sync(dict([(val,os.path.join(os.path.dirname(config_fn),key)) 
+		for key,val in kwargs.get('collect files',{}).items()]),spot,link=False)
 	# write the testset to the top directory. this is a transient file which only lives in the host?
 	if 'script' in kwargs:
-		ts = datetime.datetime.fromtimestamp(time.time()).strftime('%Y.%m.%d.%H%M')
+		# parallel tests may share a spot so the container name keeps their scripts apart
+		ts = '%s-%s'%(time.strftime('%Y.%m.%d.%H%M'),kwargs.get('container_name') or os.getpid())
 		testset_fn = 'script-run-%s.sh'%ts
 		script_header = ('#!/bin/bash\nset -e\n'+
 			'log_file=%s\n'%('log-run-%s'%ts)+
@@ -368,44 +1943,72 @@ def docker_local(**kwargs):
 	# default to root if there is no user_coda in the docker specification
 	if not docker_details.get('user_coda',False): user = 'root'
 	# prepare the run settings
-	run_settings = dict(user=user,host_site=spot,
-		container_site=container_site,container_user=container_user,image=docker_name,
-		testset_file=testset_fn if not kwargs.get('visit',True) else None,mounts_extra='')
+	visit = kwargs.get('visit',True)
+	run_spec = dict(user=user,image='%s/%s'%(container_user,docker_name),
+		name=kwargs.get('container_name'),volumes=[(spot,container_site)])
 	# extra mounts
 	for mount_from,mount_to in kwargs.get('mounts',{}).items():
-		run_settings['mounts_extra'] += ' -v %s:%s'%(mount_from,os.path.join('/home/%s'%user,mount_to))
-	run_settings['ports'] = ' '.join(['--publish=%d:%d'%((p,p) if type(p)==int 
-		else tuple([int(j) for j in p])) for p in kwargs.get('ports',[])])
-	if run_settings['ports']!='': run_settings['ports'] = ' %s '%run_settings['ports']
+		run_spec['volumes'].append((mount_from,os.path.join('/home/%s'%user,mount_to)))
+	run_spec['ports'] = [(p,p) if type(p)==int else tuple([int(j) for j in p])
+		for p in kwargs.get('ports',[])]
 	# run the docker
-	if kwargs.get('background',False)==False or kwargs.get('visit',True): 
-		run_settings['attach_mode'] = '--rm -it '
-	else: run_settings['attach_mode'] = '-d '
-	if run_settings['testset_file']!=None: 
-		run_settings['tail'] = " bash %(container_site)s/%(testset_file)s"%run_settings
-	else: run_settings['tail'] = ""
-	run_settings['namer'] = "--name=%s "%kwargs['container_name'] if 'container_name' in kwargs else ""	
-	cmd = ("docker run %(namer)s %(attach_mode)s"
-		"-u %(user)s -v %(host_site)s:%(container_site)s%(mounts_extra)s%(ports)s "
-		"%(container_user)s/%(image)s%(tail)s"
-		)%run_settings
-	#! delete the original below after testing
-	cmd_alt = (("docker run %s"%('--rm -it ' 
-		if (kwargs.get('background',False)==False or kwargs.get('visit',True)) else '-d ')+
-		"--name %s "%kwargs['container_name'] if 'container_name' in kwargs else ""+
-		"-u %(user)s -v %(host_site)s:%(container_site)s%(mounts_extra)s%(ports)s "+
-		"%(container_user)s/%(image)s ")%run_settings+(
-		"bash %(container_site)s/%(testset_file)s"%run_settings
-			if run_settings['testset_file']!=None else ""))
-	print('[STATUS] calling docker via: %s'%cmd)
-	# we wait if do_once 
+	run_spec['detach'] = not (kwargs.get('background',False)==False or visit)
+	run_spec['command'] = (['bash','%s/%s'%(container_site,testset_fn)]
+		if testset_fn!=None and not visit else [])
+	# we wait if do_once
 	do_wait = do_once or kwargs.get('wait',False)
-	# check_call raises exception on failure
-	subprocess.check_call(cmd,shell=True)
-	# wait until the container is removed. best with the back flag for detached mode
-	if do_wait:
-		#! useful place to fork a process and tail the log? obv difficult because GIL
-		subprocess.check_call('docker wait %s'%kwargs['container_name'],shell=True)
+	respond = {}
+	# warm containers are reused for scripts and we always wait for the script to finish
+	warm = kwargs.get('warm',config.get('docks_warm',False)) and testset_fn!=None and not visit
+	# resource samples are written next to the log
+	stats_interval = kwargs.get('stats',config.get('docks_stats'))
+	stats_fn = (re.sub(r'\.log$','',kwargs['log_fn'])+'.stats.json'
+		if stats_interval and kwargs.get('log_fn') else None)
+	if warm:
+		runs = int(config.get('docks_warm_runs',20))
+		name = warm_acquire(run_spec,runs=runs,idle=float(config.get('docks_warm_idle',600)))
+		status = {}
+		sampler = ResourceSampler(name,stats_interval).start() if stats_fn else None
+		try:
+			print('[STATUS] running %s in the warm container %s'%(testset_fn,name))
+			blocks = docker_backend().execute(name,run_spec['command'],user,status)
+			if kwargs.get('log_fn'):
+				respond['log'] = container_log_stream(name,kwargs['log_fn'],blocks=blocks)
+			else:
+				for block in blocks: sys.stdout.write(block.decode('utf-8','replace'))
+		finally:
+			if sampler: respond['stats'] = sampler.stop(stats_fn)['summary']
+			warm_release(name,runs)
+		respond.update(warm=name,exit_code=status.get('exit_code'))
+		if respond['exit_code']!=0:
+			print('[WARNING] the script in warm container %s exited with code %s'%(
+				name,respond['exit_code']))
+	else: docker_backend().run(run_spec)
+	# the log of a detached container is followed while it runs and the shared watcher removes it on exit
+	if not warm and do_wait and run_spec['detach']:
+		sampler = ResourceSampler(kwargs['container_name'],stats_interval).start() if stats_fn else None
+		def collect_stats(name,exit_code):
+			respond['stats'] = sampler.stop(stats_fn)['summary']
+		def follow_log(name):
+			respond['log'] = container_log_stream(name,kwargs['log_fn'])
+		def collect_log(name,exit_code):
+			# collect the whole log at once only if following it failed
+			if 'log' not in respond: respond['log'] = container_log_stream(name,kwargs['log_fn'],
+				blocks=docker_backend().logs(name,follow=False))
+		def remove(name,exit_code):
+			docker_backend().remove(name)
+			respond['removed'] = True
+		on_exit = (([collect_stats] if sampler else [])+([collect_log] if kwargs.get('log_fn') else [])+
+			([remove] if kwargs.get('wait') else []))
+		watcher = container_watcher()
+		watcher.watch(kwargs['container_name'],on_exit=on_exit,
+			stream=follow_log if kwargs.get('log_fn') else None)
+		respond['exit_code'] = watcher.wait(kwargs['container_name'])
+		if respond['exit_code']!=0:
+			print('[WARNING] container %s exited with code %s'%(
+				kwargs['container_name'],respond['exit_code']))
+	# attached runs only return once the container exits and check_call raises on failure
+	elif not warm and do_wait: respond['exit_code'] = 0
 	# clean up the testset script
 	#! currently skipping the script cleanup. RESOLVE LATER!
 	if False and testset_fn!=None: 
@@ -413,48 +2016,277 @@ def docker_local(**kwargs):
 		except: pass
 	# it is no longer necessary to clean up external mounts if they are mounted in ~/host/
 	# register this in the config if it runs only once
-	if do_once:
-		testset_history['events'] = testset_history.get('events',[])
-		event = copy.deepcopy(kwargs)
+	# failed or missing containers are never recorded as done and test raises once it has the logs
+	if do_once and respond.get('exit_code')==0:
 		#---never save the notes
-		event.pop('notes',None)
-		testset_history['events'].append(event)
-		config.update(testset_history=testset_history)
-		write_config(config)
-	respond = {'spot':spot}
+		history_event(kwargs_no_notes,fingerprint)
+	respond['spot'] = spot
 	if testset_fn: respond['script'] = testset_fn
 	return respond
 
-def docker_recap(longest=True,log=False):
-	"""Summarize docker compile times."""
-	config = read_config()
-	from datapack import asciitree
-	docker_history = config.get('docker_history',{})
-	keys = list(set([i[0] for i in docker_history]))
-	timings = dict([(key,{}) for key in keys])
-	for key in keys:
-		stamps = [i[1] for i in docker_history if i[0]==key]
-		timings[key]['timings'] = dict([(s,'%.1f min'%
-			(docker_history[(key,s)]['total_time']/60.)) for s in stamps])
-		timings[key]['sub-timings'] = ['%s, %.1f min'%(s['name'],s['elapsed']/60.) 
-			for s in docker_history[(key,s)]['series']]
+def docker_warm(clear=False):
+	"""
+	List the warm containers or remove them with `clear=True`.
+	Set `docks_warm_runs` and `docks_warm_idle` (seconds) in the config to control recycling.
+	"""
+	with docks_lock:
+		state = warm_state()
+		for name in sorted(state.keys()):
+			print('[STATUS] %s: %s, %d runs, idle for %.0f s'%(name,state[name]['image'],
+				state[name]['runs'],time.time()-state[name]['last_used']))
+			if clear: warm_retire(name,state)
+		if clear: warm_state(state)
+
+def history_columns(builds,stages):
+	"""
+	Arrange rows of builds (image,ts,elapsed) and built stages (image,ts,stage,elapsed) into numpy columns.
+	"""
+	import numpy as np
+	columns = {}
+	for kind,rows,names in [('builds',builds,['image','ts','elapsed']),
+		('stages',stages,['image','ts','stage','elapsed'])]:
+		columns[kind] = dict([(name,np.array(col,dtype=float if name=='elapsed' else str))
+			for name,col in zip(names,list(zip(*rows)) or [[]]*len(names))])
+	return columns
+
+def history_stats(groups,ts,values,window=5,percentiles=(50,90)):
+	"""
+	Summarize values by group in time order without looping over the rows.
+	Returns the group names and arrays of counts, means, percentiles, the latest value, the mean of the
+	last `window` values and of the window before that, and the baseline mean of the `window` values
+	before the latest one.
+	"""
+	import numpy as np
+	names,keys = np.unique(groups,return_inverse=True)
+	stats = dict(names=names)
+	if not len(names): return stats
+	counts = np.bincount(keys,minlength=len(names))
+	starts = np.cumsum(counts)-counts
+	ends = starts+counts
+	# percentiles interpolate within each group sorted by value
+	ordered = values[np.lexsort((values,keys))]
+	for q in percentiles:
+		pos = q/100.*(counts-1)
+		lo,hi = starts+np.floor(pos).astype(int),starts+np.ceil(pos).astype(int)
+		stats['p%d'%q] = ordered[lo]+(ordered[hi]-ordered[lo])*(pos-np.floor(pos))
+	stats['max'] = ordered[ends-1]
+	# windows over each group sorted by time come from differences of a cumulative sum
+	timed = values[np.lexsort((ts,keys))]
+	total = np.concatenate([[0.],np.cumsum(timed)])
+	def mean(lo,hi):
+		lo = np.maximum(lo,starts)
+		with np.errstate(invalid='ignore',divide='ignore'):
+			return np.where(hi>lo,(total[hi]-total[lo])/np.maximum(hi-lo,1),np.nan)
+	stats.update(count=counts,mean=(total[ends]-total[starts])/counts,latest=timed[ends-1],
+		recent=mean(ends-window,ends),prior=mean(ends-2*window,np.maximum(ends-window,starts)),
+		baseline=mean(ends-1-window,ends-1))
+	return stats
+
+def docker_recap(longest=True,log=False,since=None,profile=False,top=5,until=None,fmt=None,out=None,
+	window=5,tolerance=0.25,floor=5):
+	"""
+	Summarize docker compile times.
+	Use `profile=True` to see the slowest build steps and the cache hit rate for each build.
+	Each image reports percentiles of its build time and the trend over the last `window` builds.
+	A stage is a regression when its latest build is slower than the mean of the `window` builds before it
+	by the `tolerance` fraction and by `floor` seconds. Select builds with `since` and `until`
+	(e.g. 2018.05) and use `fmt=json` or `fmt=csv` with an optional `out` file to track them elsewhere.
+	The statistics need numpy. Use `log=True` for the plain timings as json.
+	"""
+	history_migrate()
+	window,tolerance,floor = int(window),float(tolerance),float(floor)
+	if fmt not in [None,'tree','json','csv']: raise Exception('fmt must be tree, json or csv: %s'%fmt)
+	timings,builds,stages = {},[],[]
+	for record in history_query(since=since):
+		# timestamps sort as text and every character in them comes before the tilde
+		if until!=None and record['ts']>until+'~': continue
+		key = record['name']
+		timings[key] = timings.get(key,{'timings':{}})
+		timings[key]['timings'][record['ts']] = '%.1f min'%(record['total_time']/60.)
+		# sub-timings come from the most recent build
+		timings[key]['sub-timings'] = ['%s, %.1f min'%(s['name'],s['elapsed']/60.)
+			for s in record['series']]
+		if profile: docker_recap_profile(timings[key],record)
+		builds.append((key,record['ts'],record['total_time']))
+		stages.extend([(key,record['ts'],i['name'],i['elapsed']) for i in record['series'] if not i.get('skipped')])
+	for key in timings:
 		timings[key]['longest'] = max(timings[key]['timings'].values())
-	if not log: asciitree(timings)
-	else: print(json.dumps(timings))
+		steps = timings[key].pop('steps',{})
+		if steps:
+			ranked = sorted(steps.items(),key=lambda x:-1*sum(x[1])/len(x[1]))[:int(top)]
+			timings[key]['slowest steps'] = ['%.1f min mean over %d builds: %s'%(
+				sum(v)/len(v)/60.,len(v),k) for k,v in ranked]
+	if fmt==None and log:
+		print(json.dumps(timings))
+		return
+	try: rows = docker_recap_stats(timings,builds,stages,window=window,tolerance=tolerance,floor=floor)
+	except ImportError:
+		if fmt=='csv': raise Exception('docker_recap needs numpy for fmt=csv')
+		print('[WARNING] install numpy to see build time statistics')
+		rows = []
+	if fmt in [None,'tree']:
+		from datapack import asciitree
+		asciitree(timings)
+		return
+	fp = open(out,'w') if out else sys.stdout
+	try:
+		if fmt=='json': fp.write(json.dumps(dict(timings=timings,stats=rows))+'\n')
+		else:
+			import csv
+			writer = csv.DictWriter(fp,fieldnames=['image','stage','builds','mean','p50','p90','max',
+				'latest','recent','prior','baseline','regression'])
+			writer.writeheader()
+			for row in rows: writer.writerow(row)
+	finally:
+		if out: fp.close()
+	if out: print('[STATUS] wrote the build recap to %s'%out)
 
-def test_report(*sigs,**kwargs):
-	"""Write a report for a specific testset to a file."""
+def docker_recap_stats(timings,builds,stages,window,tolerance,floor):
+	"""
+	Compute build statistics for docker_recap, add them to the timings and return them as rows.
+	Times in the rows are in seconds and each image has a row for its total with the stage "total".
+	"""
+	import numpy as np
+	columns = history_columns(builds,stages)
+	builds = history_stats(columns['builds']['image'],columns['builds']['ts'],
+		columns['builds']['elapsed'],window=window)
+	stages = history_stats(np.array(['%s\t%s'%i for i in zip(columns['stages']['image'],
+		columns['stages']['stage'])],dtype=str),columns['stages']['ts'],columns['stages']['elapsed'],window=window)
+	regressed = ((stages['latest']>stages['baseline']*(1+tolerance))&
+		(stages['latest']-stages['baseline']>floor)) if len(stages['names']) else np.array([],dtype=bool)
+	rows = []
+	for kind,stats,flags in [('builds',builds,None),('stages',stages,regressed)]:
+		for index,name in enumerate(stats['names']):
+			image,stage = (name,'total') if kind=='builds' else name.split('\t',1)
+			row = dict(image=image,stage=stage,builds=int(stats['count'][index]))
+			row.update([(k,None if np.isnan(stats[k][index]) else round(float(stats[k][index]),1))
+				for k in ['mean','p50','p90','max','latest','recent','prior','baseline']])
+			row['regression'] = bool(flags[index]) if flags is not None else False
+			rows.append(row)
+	for row in rows:
+		item = timings[row['image']]
+		if row['stage']=='total':
+			# the numeric maximum replaces the maximum of the formatted strings
+			item['longest'] = '%.1f min'%(row['max']/60.)
+			item['percentiles'] = 'p50 %.1f min, p90 %.1f min over %d builds'%(
+				row['p50']/60.,row['p90']/60.,row['builds'])
+			if row['prior']: item['trend'] = '%.1f min for the last %d builds and %.1f min before (%+.0f%%)'%(
+				row['recent']/60.,window,row['prior']/60.,100.*(row['recent']/row['prior']-1))
+		elif row['regression']:
+			item.setdefault('regressions',[]).append('%s: %.1f min against a mean of %.1f min'%(
+				row['stage'],row['latest']/60.,row['baseline']/60.))
+	return rows
+
+def docker_recap_profile(timing,record):
+	"""Collect step times and cache hits from one build for docker_recap."""
+	profiles = [i['profile'] for i in record['series'] if i.get('profile')]
+	if not profiles: return
+	hits,total = sum([i['cache_hits'] for i in profiles]),sum([i['cache_total'] for i in profiles])
+	context = sum([i['context_size'] or 0 for i in profiles])
+	timing.setdefault('cache hits',{})[record['ts']] = '%d/%d cached (%.0f%%), context %.1f MB'%(
+		hits,total,100.*hits/total if total else 0.,context/10.**6)
+	for profile in profiles:
+		for step in profile['steps']:
+			# cached steps would only dilute the cost of building a step
+			if step['cached'] or step['elapsed']==None: continue
+			instruction = step['instruction'] if len(step['instruction'])<=80 else step['instruction'][:77]+'...'
+			timing.setdefault('steps',{}).setdefault(instruction,[]).append(step['elapsed'])
+
+def docker_gc(keep=3,keep_containers=3,dry=False,username=container_user):
+	"""
+	Remove stage images and exited containers which docks left behind and report the space reclaimed.
+	Stage images (name-sN) and shared prefix images (docks-prefix-*) are kept only for the `keep`
+	sequences built most recently, and only if the latest build of those sequences still uses them.
+	The `keep_containers` most recent exited test containers are kept so their logs remain available.
+	Containers from images which were rebuilt since they ran have lost their tag and are included.
+	Use `dry=True` to see what would be removed.
+	"""
+	history_migrate()
+	keep,keep_containers,backend = int(keep),int(keep_containers),docker_backend()
+	index = history_index()
+	recent = sorted(index.keys(),key=lambda name:index[name].get('ts') or '',reverse=True)[:keep]
+	# images which the latest builds of the recent sequences depend on
+	used = set()
+	latest = {}
+	for record in history_query(): latest[record['name']] = record
+	for name in recent:
+		used.update(index[name].get('stages',{}).keys())
+		used.update([i.get('image') for i in latest.get(name,{}).get('series',[]) if i.get('image')])
+	images,listed = [],backend.images()
+	for image in listed:
+		if not image['tag'].startswith(username+'/'): continue
+		short = image['tag'][len(username)+1:].split(':')[0]
+		stage = re.match(r'^(.+)-s\d+$',short)
+		# only stage images of sequences in the history belong to docks
+		if (short.startswith('docks-prefix-') or (stage and stage.group(1) in index and short not in index)):
+			if short not in used: images.append(image)
+	# docker reports the image of a container by its bare ID once the tag moves to a rebuilt image
+	short_id = lambda x: x.split(':')[-1][:12]
+	tagged = set([short_id(i['id']) for i in listed])
+	untagged = lambda x: (re.match(r'^(sha256:)?[0-9a-f]{12,64}$',x) and short_id(x) not in tagged)
+	# exited containers from our images except those which a test is still waiting on
+	watched = set(docks_watcher.watches.keys()) if docks_watcher else set()
+	containers = sorted([i for i in backend.containers() 
+		if (i['image'].startswith(username+'/') or untagged(i['image']))
+		and not i['running'] and not i['name'].startswith('docks-warm-') and i['name'] not in watched],
+		key=lambda x:x['created'],reverse=True)[keep_containers:]
+	for image in images: print('[STATUS] %s image %s (%.1f MB)'%(
+		'would remove' if dry else 'removing',image['tag'],image['size']/10.**6))
+	for container in containers: print('[STATUS] %s container %s'%(
+		'would remove' if dry else 'removing',container['name']))
+	if dry:
+		print('[STATUS] would remove %d images (up to %.1f MB) and %d containers'%(
+			len(images),sum([i['size'] for i in images])/10.**6,len(containers)))
+		return
+	before = backend.disk_usage()
+	# containers go first since they hold on to their images
+	for container in containers:
+		try: backend.remove(container['name'])
+		except DockerError as e: print('[WARNING] failed to remove %s: %s'%(container['name'],e))
+	for image in images:
+		try: backend.remove_image(image['tag'])
+		except DockerError as e: print('[WARNING] failed to remove %s: %s'%(image['tag'],e))
+	reclaimed = before-backend.disk_usage()
+	print('[STATUS] removed %d images and %d containers and reclaimed %.1f MB'%(
+		len(images),len(containers),reclaimed/10.**6))
+	return dict(images=[i['tag'] for i in images],containers=[i['name'] for i in containers],
+		reclaimed=reclaimed)
+
+def docker_gc_hook(config):
+	"""
+	Collect garbage after a build if `docks_gc` in the config is true or a number of sequences to keep.
+	Set `docks_gc_containers` to the number of exited containers to keep.
+	"""
+	if not config.get('docks_gc'): return
+	try: docker_gc(keep=3 if config['docks_gc'] is True else int(config['docks_gc']),
+		keep_containers=int(config.get('docks_gc_containers',3)))
+	except DockerError as e: print('[WARNING] garbage collection failed: %s'%e)
+
+def docker_history_compact(keep=50):
+	"""Keep only the most recent builds of each image in the history."""
+	history_migrate()
+	history_compact(keep=keep)
+
+def write_files_local(write_files,config_fn):
+	"""Write the files embedded in a testset next to the docker config unless they are unchanged."""
+	for fn,text in write_files.items():
+		path = os.path.join(os.path.dirname(config_fn),fn)
+		if os.path.isfile(path):
+			with open(path) as fp:
+				if fp.read()==text: continue
+		with open(path,'w') as fp: fp.write(text)
+
+def test_report_render(sigs,prepped,read_source):
+	"""
+	Render the report for a testset without the timestamp.
+	Files listed in `report files` come from `read_source` so that a batch can read each one once.
+	"""
 	import textwrap
 	liner = lambda x,indent=0,indent_sub=2: '\n'.join(
 		textwrap.wrap(x,width=110-indent,subsequent_indent=' '*indent_sub))
 	formatter = lambda title,*x: '%s\n'%title+'\n'.join(['%s%s'%(
 		' '*2,liner(i,indent=2,indent_sub=4)) for i in x])
-	# get the testset instructions
-	prepped = test_run(*sigs,**kwargs)
-	# generate timestamp
-	ts = datetime.datetime.fromtimestamp(time.time()).strftime('%Y.%m.%d.%H%M')
-	text = ['# FACTORY TESTSET REPORT: "%s"'%'_'.join(sigs)]
-	text += ['This report was generated on: %s.'%ts]
+	text = []
 	# start with notes
 	notes = prepped.get('notes',None)
 	if notes: text += ['> NOTES:\n%s'%'\n'.join(['  %s'%i for i in notes.strip().splitlines()])]
@@ -462,8 +2294,8 @@ def test_report(*sigs,**kwargs):
 	text += ['RUN COMMAND: `make test %s`'%' '.join(sigs)]
 	# handle once flag
 	if prepped.get('once',False): text += [formatter('SINGLE USE:',
-		'This testset runs once and is then recorded in the `factory/config.py` variable ',
-		'called "testset_history" so that it is not repeated.')]
+		'This testset runs once and is then recorded in the testset history ',
+		'(see `%s/history/events.jsonl`) so that it is not repeated.'%docks_state)]
 	# report the docker
 	text += [formatter('DOCKER IMAGE:',
 		'This testset uses the docker image "%s/%s".'%(container_user,prepped['docker']),
@@ -471,11 +2303,6 @@ def test_report(*sigs,**kwargs):
 	# location on disk
 	where = prepped.get('where',False)
 	if where: text += [formatter('LOCATION:','This docker is mounted to the host disk at `host/%s`.'%where)]
-	# you can embed some files directly in the YAML (this is useful for files that change ports)
-	write_files = prepped.get('write files',{})
-	if write_files:
-		for fn,text in write_files.items():
-			with open(os.path.join(os.path.dirname(config['docks_config']),fn),'w') as fp: fp.write(text)
 	# files that get copied
 	collect_files = prepped.get('collect files',{})
 	if collect_files:
@@ -486,23 +2313,83 @@ def test_report(*sigs,**kwargs):
 	prelim = prepped.get('preliminary',False)
 	if prelim: text += [formatter('PRELIMINARY SCRIPT (runs in the host):\n',
 		'#!/bin/bash','set -e',*prelim.splitlines())]
+	for kind in ['inputs','outputs']:
+		paths = prepped.get('preliminary %s'%kind)
+		if type(paths) in str_types: paths = paths.split()
+		if paths: text += [formatter('PRELIMINARY %s:'%kind.upper(),
+			'The preliminary script is skipped when these are unchanged since its last run.',
+			*[' '*2+i for i in paths])]
 	# write the main script
 	script = prepped.get('script',False)
 	if script: text += [formatter('MAIN SCRIPT (runs in the container):\n',
 		'#!/bin/bash','set -e',*script.splitlines())]
-	# reproduce other files
-	report_files = prepped.get('report files',None)
-	if report_files:
-		# get location of the testset sources via the docks_config
-		config = read_config()
-		if 'docks_config' not in config: raise Exception('cannot find docks_config')
-		for fn in report_files:
-			with open(os.path.join(os.path.dirname(config['docks_config']),fn)) as fp:
-				text += ['## file contents: "%s"\n\n~~~\n%s\n~~~'%(fn,fp.read().strip())]
-	# write the report
+	# reproduce other files which live next to the docker config
+	for fn in prepped.get('report files',None) or []:
+		text += ['## file contents: "%s"\n\n~~~\n%s\n~~~'%(fn,
+			read_source(os.path.join(os.path.dirname(prepped['config_fn']),fn)).strip())]
+	return text
+
+def test_report_write(sigs,body):
+	"""Write a report unless only its timestamp would change. Returns the file name if it was written."""
 	fn = 'report-%s.md'%('_'.join(sigs))
-	with open(fn,'w') as fp: fp.write('\n\n'.join(text))
-	print('[STATUS] write report to %s'%fn)
+	stamp = 'This report was generated on: %s.'
+	head = '# FACTORY TESTSET REPORT: "%s"'%'_'.join(sigs)
+	if os.path.isfile(fn):
+		# the body may contain blank lines so we only split off the heading and the timestamp
+		with open(fn) as fp: parts = fp.read().split('\n\n',2)
+		if (len(parts)==3 and parts[0]==head and re.match(r'^This report was generated on: [^\n]*\.$',parts[1])
+			and parts[2]=='\n\n'.join(body)): return None
+	with open(fn,'w') as fp: fp.write('\n\n'.join([head,stamp%time.strftime('%Y.%m.%d.%H%M')]+body))
+	return fn
+
+def test_report(*sigs,**kwargs):
+	"""Write a report for a specific testset to a file."""
+	# get the testset instructions
+	prepped = test_run(*sigs,**kwargs)
+	# you can embed some files directly in the YAML (this is useful for files that change ports)
+	write_files_local(prepped.get('write files',{}),prepped['config_fn'])
+	def read_source(fn):
+		with open(fn) as fp: return fp.read()
+	fn = test_report_write(sigs,test_report_render(sigs,prepped,read_source))
+	if fn: print('[STATUS] write report to %s'%fn)
+	else: print('[STATUS] the report for %s is unchanged'%'_'.join(sigs))
+
+def test_report_all(names=None,workers=4,config=None,mods=None):
+	"""
+	Write reports for every testset (or e.g. `names="alpha one,beta two"`) from one interpretation
+	of the docker config. Reports are rendered in parallel, files in `report files` are read once
+	and only reports whose contents changed are rewritten.
+	"""
+	import copy
+	from multiprocessing.pool import ThreadPool
+	if config==None: config = read_config().get('docks_config','docker_config.py')
+	cached = interpret_docker_cached(config=config,mods=mods)
+	tests = cached['instruct'].get('tests',{})
+	if names==None: names = sorted(tests.keys())
+	elif type(names) in str_types: names = names.split(',')
+	missing = [name for name in names if name not in tests]
+	if missing: raise Exception('cannot find tests %s in: %s'%(missing,sorted(tests.keys())))
+	prepped = dict([(name,dict(copy.deepcopy(tests[name]),config_fn=config)) for name in names])
+	# embedded files are written in order since testsets may share them
+	for name in names: write_files_local(prepped[name].get('write files',{}),config)
+	sources,sources_lock = {},threading.Lock()
+	def read_source(fn):
+		with sources_lock:
+			if fn not in sources:
+				with open(fn) as fp: sources[fn] = fp.read()
+			return sources[fn]
+	def render(name):
+		sigs = name.split()
+		return test_report_write(sigs,test_report_render(sigs,prepped[name],read_source))
+	pool = ThreadPool(int(workers))
+	try: written = pool.map(render,names)
+	finally: 
+		pool.close()
+		pool.join()
+	for fn in [i for i in written if i]: print('[STATUS] write report to %s'%fn)
+	print('[STATUS] wrote %d of %d reports and %d were unchanged'%(
+		len([i for i in written if i]),len(names),len([i for i in written if not i])))
+	return [i for i in written if i]
 
 def avail(config=None,mods=None,**kwargs):
 	"""List available tests."""
@@ -513,46 +2400,482 @@ def avail(config=None,mods=None,**kwargs):
 	if config==None: config = config_dict.get('docks_config','docker_config.py')
 	if kwargs: raise Exception('unprocessed kwargs %s'%kwargs)
 	# get the interpreted docker configuration
-	instruct = interpret_docker_instructions(config=config,mods=mods)
+	cached = interpret_docker_cached(config=config,mods=mods)
 	from datapack import asciitree	
-	tests_these = dict(tests=instruct.get('tests',{}).keys())
+	tests_these = dict(tests=sorted([j for i in cached['catalog'].values() for j in i]))
 	asciitree(tests_these)
 	return tests_these
 
-def gitscan(where,wide=False):
+def startup(commands='avail,docker_list',repeat=5,budget=50):
+	"""
+	Benchmark the time to import this module and run quick commands in a fresh interpreter.
+	Times are the median over `repeat` runs after subtracting the interpreter startup.
+	"""
+	import subprocess
+	repeat = int(repeat)
+	here = os.path.dirname(os.path.abspath(__file__))
+	env = dict(os.environ,PYTHONPATH=os.pathsep.join([here]+
+		[i for i in [os.environ.get('PYTHONPATH')] if i]))
+	def timed(code,*flags):
+		times = []
+		for i in range(repeat):
+			start_time = time.time()
+			proc = subprocess.Popen([sys.executable]+list(flags)+['-c',code],env=env,
+				stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+			stdout,stderr = proc.communicate()
+			times.append(time.time()-start_time)
+			if proc.returncode!=0: return None,stderr.decode('utf-8').strip().splitlines()[-1:]
+		return sorted(times)[len(times)//2]*1000.,stderr.decode('utf-8')
+	baseline,_ = timed('pass')
+	print('[TIME] interpreter startup: %.1f ms'%baseline)
+	# the import time tree shows which modules are imported on load
+	elapsed,stderr = timed('import docks','-X','importtime')
+	if elapsed==None: raise Exception('failed to import docks: %s'%stderr)
+	print('[TIME] import docks: %.1f ms'%(elapsed-baseline))
+	rows = [[j.rstrip() for j in i.split(':',1)[1].split('|')] for i in stderr.splitlines()
+		if i.startswith('import time:') and not i.startswith('import time: self')]
+	if rows:
+		start = max([ii for ii,i in enumerate(rows) if i[2]==' docks'][:1] or [0])
+		while start>0 and rows[start-1][2].startswith('  '): start -= 1
+		for row in sorted(rows[start:],key=lambda x:-1*int(x[1]))[:6]:
+			print('[TIME] | %6.1f ms cumulative: %s'%(int(row[1])/1000.,row[2].strip()))
+	over = []
+	for command in (commands.split(',') if type(commands) in str_types else commands):
+		elapsed,stderr = timed('import docks;docks.%s()'%command)
+		if elapsed==None:
+			print('[WARNING] %s failed: %s'%(command,' '.join(stderr)))
+			continue
+		print('[TIME] %s: %.1f ms'%(command,elapsed-baseline))
+		if elapsed-baseline>float(budget): over.append(command)
+	if over: print('[WARNING] over the %s ms budget: %s'%(budget,', '.join(over)))
+	else: print('[STATUS] every command is within the %s ms budget'%budget)
+
+class ConfigMemory(object):
+	"""
+	Config interface which keeps the config in memory so that benchmarks never touch the real one.
+	"""
+	def __init__(self,config):
+		self.config = config
+	def read_config(self):
+		import copy
+		return copy.deepcopy(self.config)
+	def write_config(self,config):
+		self.config = config
+	def import_remote(self,fn):
+		mod = {}
+		with open(fn) as fp: exec(fp.read(),mod)
+		return mod
+
+def bench_config(where,scale):
+	"""
+	Write a synthetic docker configuration with sequences, requirements, tests and a large history.
+	Returns the config with requirement paths and history which we would expect from read_config.
+	"""
+	scale = int(scale)
+	steps = ['base']+['step%d'%i for i in range(scale)]
+	dockerfiles = dict([(step,''.join(['RUN echo %s %d\n'%(step,j) for j in range(4)]))
+		for step in steps])
+	dockerfiles['base'] = 'FROM debian\nRUN apt-get update\nRUN echo @USER\n'
+	config = dict(docks_config=os.path.join(where,'docker_config.py'),user_creds='bench')
+	requirements = {}
+	for dn in ['reqs','spots']:
+		if not os.path.isdir(os.path.join(where,dn)): os.makedirs(os.path.join(where,dn))
+	# every tenth step copies a file from the config
+	for num,step in enumerate(steps[1::10]):
+		config['bench_req%d'%num] = os.path.join(where,'reqs','req%d.tar'%num)
+		with open(config['bench_req%d'%num],'w') as fp: fp.write('%d\n'%num*1000)
+		dockerfiles[step] += 'COPY FILE /opt/\n'
+		requirements[step] = dict(config_keys='bench_req%d'%num,filename_sub='FILE')
+	# sequences share prefixes in the way that real configurations usually do
+	sequences,tests = {},{}
+	for num in range(scale):
+		seq = ' '.join(['base']+steps[1+num//10*10:2+num][-4:])
+		sequences['seq%d'%num] = dict(seq=seq,user=num%3==0) if num%2==0 else seq
+		tests['test%d bench'%num] = dict(docker='seq%d'%num,where=os.path.join(where,'spots','test%d'%num),
+			script='echo test %d\necho unit test is complete\n'%num,once=num%4==0,
+			notes='synthetic test %d'%num)
+		if num%5==0: tests['test%d bench'%num]['collect files'] = {'req0.tar':'data.tar'}
+	with open(config['docks_config'],'w') as fp:
+		fp.write('def interpreter(mods=None):\n\treturn %s\n'%repr(dict(dockerfiles=dockerfiles,
+			sequences=sequences,requirements=requirements,tests=tests)))
+	with open(os.path.join(where,'req0.tar'),'w') as fp: fp.write('data\n')
+	# a large history from the days when it was stored in the config
+	config['docker_history'],events = {},[]
+	for num in range(scale):
+		for build in range(10):
+			texts = [(i,dockerfiles[i]) for i in ['base','step%d'%num]]
+			config['docker_history'][('seq%d'%num,'2020.01.%02d.%04d'%(build+1,num%2400))] = dict(
+				series=[dict(name='everything',elapsed=float(60+num+build))],
+				texts=texts,total_time=float(60+num+build))
+		events.append(dict(tests['test%d bench'%num],docker='seq%d'%num))
+	config['testset_history'] = dict(events=events,fingerprints=dict(
+		[(event_fingerprint(event),'2020.01.01.0000') for event in events]))
+	with open(os.path.join(where,'megatest.yaml'),'w') as fp:
+		fp.write('sequence:\n'+''.join(['  - %s\n'%i for i in sorted(tests)]))
+	return config
+
+def bench(scales='10,100,300',sample=20,workers=4,save=False,tolerance=0.25,floor=5):
+	"""
+	Benchmark the orchestration in this module with a fake docker backend and synthetic configurations.
+	Each scale sets the number of sequences and tests while `sample` sets how many we build and run.
+	Use `save=True` to record a baseline in the state folder. Later runs report regressions against it
+	when a time exceeds the baseline by the fractional `tolerance` and `floor` milliseconds.
+	"""
+	global docks_backend,docks_config,docks_config_interface,docks_watcher
+	import tempfile,shutil
+	baseline_fn = os.path.abspath(state_fn('bench-baseline.json'))
+	baseline = {}
+	if os.path.isfile(baseline_fn):
+		with open(baseline_fn) as fp: baseline = json.load(fp)
+	scales = [int(i) for i in (scales.split(',') if type(scales) in str_types else scales)]
+	sample = int(sample)
+	here,stdout = os.getcwd(),sys.stdout
+	saved = (docks_backend,docks_config,docks_config_interface,docks_watcher)
+	results,regressions = {},[]
+	for scale in scales:
+		where = tempfile.mkdtemp(prefix='docks-bench-')
+		timings = results[str(scale)] = {}
+		def timed(label,function,*args,**kwargs):
+			start_time = time.time()
+			try:
+				sys.stdout = open(os.devnull,'w')
+				function(*args,**kwargs)
+			finally:
+				sys.stdout.close()
+				sys.stdout = stdout
+			timings[label] = (time.time()-start_time)*1000.
+		try:
+			os.chdir(where)
+			config = bench_config(where,scale)
+			docks_config_interface,docks_config = ConfigMemory(config),None
+			docks_backend,docks_watcher = DockerFake(),None
+			docks_instruct_cache.clear()
+			docks_template_cache.clear()
+			names = ['seq%d'%i for i in range(min(sample,scale))]
+			tests = [('test%d'%i,'bench') for i in range(min(sample,scale))]
+			timed('migrate',history_migrate)
+			# sequential builds use different sequences since the others are already built
+			timed('docker',lambda:[docker(name) for name in names[::2]])
+			timed('docker unchanged',lambda:[docker(name) for name in names[::2]])
+			timed('docker sequential',lambda:[docker(name,sequential=True) for name in names[1::2]])
+			timed('test_run',lambda:[test_run(*sigs) for sigs in tests])
+			def run_local():
+				for sigs in tests:
+					prepped = test_run(*sigs)
+					prepped.update(container_name='_'.join(sigs),wait=True)
+					docker_execute_local(**prepped)
+			timed('docker_local',run_local)
+			os.mkdir('logs')
+			with open('megatest-sample.yaml','w') as fp:
+				fp.write('sequence:\n'+''.join(['  - %s\n'%' '.join(i) for i in tests]))
+			timed('megatest',megatest,'megatest-sample.yaml','logs',workers=workers)
+			timed('megatest check',megatest,'megatest-sample.yaml','logs',check=True)
+			timed('docker_recap',docker_recap,log=True,profile=True)
+		finally:
+			os.chdir(here)
+			if docks_watcher: docks_watcher.stop()
+			docks_backend,docks_config,docks_config_interface,docks_watcher = saved
+			docks_instruct_cache.clear()
+			shutil.rmtree(where)
+		for label in sorted(timings):
+			before = baseline.get(str(scale),{}).get(label)
+			compare = ''
+			if before!=None:
+				compare = ' (baseline %.1f ms, %+.0f%%)'%(before,100.*(timings[label]-before)/before)
+				if timings[label]>before*(1+float(tolerance)) and timings[label]-before>float(floor):
+					regressions.append('%s at scale %d'%(label,scale))
+			print('[TIME] scale %d, %s: %.1f ms%s'%(scale,label,timings[label],compare))
+	if save:
+		baseline.update(results)
+		with open(baseline_fn,'w') as fp: json.dump(baseline,fp,indent=2,sort_keys=True)
+		print('[STATUS] saved the benchmark baseline to %s'%baseline_fn)
+	if regressions: print('[WARNING] regressions: %s'%', '.join(regressions))
+	elif baseline and not save: print('[STATUS] no regressions against %s'%baseline_fn)
+	return results
+
+def git_repos(where,skip=None):
+	"""
+	Walk a tree for git repositories without descending into a repository or any skipped folder.
+	"""
+	skip = set(git_skip+(skip.split(',') if type(skip) in str_types else list(skip or [])))
+	for dn,dns,fns in os.walk(where):
+		if '.git' in dns or '.git' in fns:
+			yield dn
+			dns[:] = []
+		else: dns[:] = sorted([i for i in dns if i not in skip])
+
+def git_dir(repo):
+	"""Find the git folder for a repository including worktrees and submodules."""
+	path = os.path.join(repo,'.git')
+	if os.path.isfile(path):
+		with open(path) as fp: text = fp.read().strip()
+		if text.startswith('gitdir:'): path = os.path.join(repo,text[len('gitdir:'):].strip())
+	return os.path.abspath(path)
+
+def git_common(gitdir):
+	"""Worktrees keep shared references and the config in a common folder."""
+	if not os.path.isfile(os.path.join(gitdir,'commondir')): return gitdir
+	with open(os.path.join(gitdir,'commondir')) as fp: 
+		return os.path.abspath(os.path.join(gitdir,fp.read().strip()))
+
+def git_read_ref(gitdir,ref):
+	"""Read a reference from a loose file or from packed-refs."""
+	common = git_common(gitdir)
+	for dn in [gitdir,common]:
+		if os.path.isfile(os.path.join(dn,ref)):
+			with open(os.path.join(dn,ref)) as fp: return fp.read().strip()
+	if os.path.isfile(os.path.join(common,'packed-refs')):
+		with open(os.path.join(common,'packed-refs')) as fp:
+			for line in fp:
+				if line.strip().endswith(' '+ref): return line.split()[0]
+	return None
+
+def git_read(repo):
+	"""
+	Read the HEAD commit, origin, and commit time of a repository directly from the git folder.
+	We only call git for commits which are stored in packs.
+	"""
+	import subprocess
+	import zlib
+	gitdir = git_dir(repo)
+	with open(os.path.join(gitdir,'HEAD')) as fp: head = fp.read().strip()
+	commit = git_read_ref(gitdir,head[len('ref:'):].strip()) if head.startswith('ref:') else head
+	origin = None
+	config_fn = os.path.join(git_common(gitdir),'config')
+	if os.path.isfile(config_fn):
+		with open(config_fn) as fp: text = fp.read()
+		match = re.search(r'\[remote "origin"\][^\[]*?^\s*url\s*=\s*(.*?)\s*$',text,re.M|re.S)
+		if match: origin = match.group(1)
+	when = None
+	if commit:
+		loose = os.path.join(git_common(gitdir),'objects',commit[:2],commit[2:])
+		try:
+			with open(loose,'rb') as fp: raw = zlib.decompress(fp.read()).decode('utf-8','replace')
+			stamp,offset = re.search(r'^committer .*? (\d+) ([+-]\d{4})$',raw,re.M).groups()
+		except Exception:
+			stamp,offset = subprocess.check_output(['git','log','-1','--format=%ct %cd','--date=format:%z'],
+				cwd=repo).decode('utf-8').split()
+		# report the time in the timezone of the commit to match git log
+		offset = (1 if offset[0]=='+' else -1)*(int(offset[1:3])*3600+int(offset[3:5])*60)
+		when = time.strftime('%Y.%m.%d.%H%M',time.gmtime(int(stamp)+offset))
+	return dict(path=os.path.join(repo,'.git'),commit=commit,origin=origin,time=when)
+
+def git_survey(where,skip=None,workers=8,cache=True):
+	"""
+	Read every repository under a folder in a thread pool with a cache keyed by HEAD and index mtimes.
+	"""
+	from multiprocessing.pool import ThreadPool
+	cache_fn = state_fn('gitscan.json')
+	cached = {}
+	if cache and os.path.isfile(cache_fn):
+		with open(cache_fn) as fp: cached = json.load(fp)
+	def stamp(gitdir):
+		return [os.path.getmtime(os.path.join(gitdir,i)) if os.path.exists(os.path.join(gitdir,i)) 
+			else None for i in ['HEAD','index','config']]
+	def survey(repo):
+		gitdir = git_dir(repo)
+		this_stamp = stamp(gitdir)
+		if gitdir in cached and cached[gitdir]['stamp']==this_stamp: return cached[gitdir]['result']
+		try: result = git_read(repo)
+		except Exception as e: result = dict(path=os.path.join(repo,'.git'),error=str(e))
+		cached[gitdir] = dict(stamp=this_stamp,result=result)
+		return result
+	pool = ThreadPool(int(workers))
+	try: results = pool.map(survey,list(git_repos(where,skip=skip)))
+	finally:
+		pool.close()
+		pool.join()
+	if cache:
+		with open(cache_fn,'w') as fp: json.dump(cached,fp)
+	return results
+
+def gitscan(where,wide=False,skip=None,log=False,workers=8,cache=True):
 	"""
 	Scan for any git repositories.
+	Skip folders with e.g. `skip=data,archive` and use `log=True` for JSON.
 	"""
-	git_get_time = "$(git log -1 --format=%cd --date=format:'%Y.%m.%d.%H%M')"
-	git_get_commit = '$(git config --get remote.origin.url)"/commit/"$(git rev-parse --short HEAD)'
-	if not wide:
-		os.system('for i in $(find %s -name .git -type d); do (cd $i && '%where+
-			'echo "$i\n\t%s\n\t%s"'%(git_get_commit,git_get_time)+
-			'); done')
-	else:
-		os.system('for i in $(find %s -name .git -type d); do (cd $i && '%where+
-			'echo "%s %s $i"'%(git_get_time,git_get_commit)+
-			'); done')
+	results = git_survey(where,skip=skip,workers=workers,cache=cache)
+	if log: 
+		print(json.dumps(results))
+		return results
+	for result in results:
+		commit = '%s/commit/%s'%(result.get('origin') or '',(result.get('commit') or '')[:7])
+		if not wide: print('%s\n\t%s\n\t%s'%(result['path'],commit,result.get('time')))
+		else: print('%s %s %s'%(result.get('time'),commit,result['path']))
+	return results
 
-def gitcheck(where):
+def gitcheck(where,skip=None,log=False,workers=8):
 	"""
 	Check for outstanding commits.
 	Try e.g. `make gitcheck where=pier/factory`
 	"""
-	os.system(('for i in $(find %s -name .git -type d); do echo "\nchecking $i" && echo $(cd $(dirname $i) '
-		'&& git status); done'%where))
+	import subprocess
+	from multiprocessing.pool import ThreadPool
+	def status(repo):
+		try: return subprocess.check_output(['git','status'],cwd=repo,
+			stderr=subprocess.STDOUT).decode('utf-8')
+		except subprocess.CalledProcessError as e: return e.output.decode('utf-8')
+	repos = list(git_repos(where,skip=skip))
+	pool = ThreadPool(int(workers))
+	try: statuses = dict(zip(repos,pool.map(status,repos)))
+	finally:
+		pool.close()
+		pool.join()
+	if log: print(json.dumps(statuses))
+	else:
+		for repo in repos: 
+			print('\nchecking %s\n%s'%(os.path.join(repo,'.git'),' '.join(statuses[repo].split())))
+	return statuses
+
+def megatest_durations(names=None,record=None):
+	"""
+	Estimate test durations from previous megatest runs or record a new one.
+	"""
+	fn = state_fn('megatest-durations.json')
+	with docks_lock:
+		durations = {}
+		if os.path.isfile(fn):
+			with open(fn) as fp: durations = json.load(fp)
+		if record:
+			# keep only a few recent durations for each test
+			for name,elapsed in record.items(): 
+				durations[name] = (durations.get(name,[])+[elapsed])[-5:]
+			with open(fn,'w') as fp: json.dump(durations,fp)
+	return dict([(name,sum(durations[name])/len(durations[name])) 
+		for name in (names if names!=None else durations) if durations.get(name)])
 
-def megatest(instruct,via,check=False,clear=None):
+def megatest_run(name,via,stats=None):
+	"""
+	Run a single megatest entry and record its duration.
+	"""
+	name_spaceless = '_'.join(name.split())
+	print('[STATUS] megatest is running test %s'%(name_spaceless))
+	start_time = time.time()
+	# RUN THE TEST
+	# note that you can set visit below to drop in and see the container without executing
+	# ... which was useful for debugging the mounts
+	respond = test(*name.split(),back=True,wait=True,log=True,visit=False,stats=stats,
+		dump_raw_test=os.path.join(via,'%s.yaml'%name_spaceless))
+	megatest_durations(record={name_spaceless:time.time()-start_time})
+	if respond and not respond.get('complete'):
+		print('[WARNING] test %s exited without reporting that it is complete'%name_spaceless)
+
+def megatest_parallel(names,via,workers,stats=None):
+	"""
+	Run megatest entries in a bounded pool with the longest tests first.
+	"""
+	from multiprocessing.pool import ThreadPool
+	# build each image once before the tests race to build it
+	for image in sorted(set([test_run(*name.split())['docker'] for name in names])):
+		docker(name=image)
+	# schedule longest-first with tests that have no history at the front since they might be long
+	durations = megatest_durations(['_'.join(name.split()) for name in names])
+	order = sorted(names,key=lambda name:(
+		'_'.join(name.split()) in durations,-1*durations.get('_'.join(name.split()),0)))
+	print('[STATUS] megatest is running %d tests with %d workers'%(len(order),workers))
+	if not os.path.isdir('logs'): os.mkdir('logs')
+	failed = []
+	def runner(name):
+		try: megatest_run(name,via,stats=stats)
+		except Exception as e:
+			print('[WARNING] megatest failed on %s: %s'%(name,e))
+			failed.append(name)
+	pool = ThreadPool(workers)
+	try: pool.map(runner,order,chunksize=1)
+	finally:
+		pool.close()
+		pool.join()
+	if failed: raise Exception('megatest failed on: %s'%', '.join(failed))
+
+def file_contains(fn,marker,chunk=2**16):
+	"""
+	Search a file for a marker in chunks starting from the end, since markers are usually near the end.
+	"""
+	marker = marker.encode('utf-8')
+	with open(fn,'rb') as fp:
+		fp.seek(0,2)
+		pos,head = fp.tell(),b''
+		while pos>0:
+			size = min(chunk,pos)
+			pos -= size
+			fp.seek(pos)
+			# the head of the later block catches a marker split across the boundary
+			block = fp.read(size)+head
+			if marker in block: return True
+			head = block[:len(marker)-1]
+	return False
+
+def megatest_scan(via,name):
+	"""
+	Read the result of one megatest entry from its log and script.
+	Tests record the completion marker while streaming, otherwise we search the log for it.
+	"""
+	import yaml
+	complete_fn = os.path.join(via,'%s.complete.json'%name)
+	if os.path.isfile(complete_fn):
+		with open(complete_fn) as fp: complete = json.load(fp)
+		result = dict(passed=complete['complete'],exit_code=complete['exit_code'])
+		if complete.get('elapsed')!=None: result['complete_elapsed'] = complete['elapsed']
+	else: result = dict(passed=file_contains(os.path.join(via,'%s.log'%name),'unit test is complete'))
+	# peak and mean resource use from sampling
+	stats_fn = os.path.join(via,'%s.stats.json'%name)
+	if os.path.isfile(stats_fn):
+		with open(stats_fn) as fp: result['resources'] = json.load(fp)['summary']
+	# collect special instructions if passed
+	script_fn = os.path.join(via,'%s.script.sh'%name)
+	if not os.path.isfile(script_fn): return result
+	with open(script_fn,'r') as fp: text = fp.read()
+	special = re.search('### special summary (.*?)\n',text,re.M)
+	if special:
+		result['special'] = yaml.safe_load(special.group(1))
+		spot = re.search('^spot=(.*?)\n',text,re.M)
+		if spot: result['spot'] = spot.group(1).strip()
+	return result
+
+def megatest_report(via,names,workers=8):
+	"""
+	Scan megatest results concurrently with a cache keyed by the size and mtime of each file.
+	"""
+	from multiprocessing.pool import ThreadPool
+	cache_fn = state_fn('megatest-scan.json')
+	cache = {}
+	if os.path.isfile(cache_fn):
+		with open(cache_fn) as fp: cache = json.load(fp)
+	def stamp(name):
+		stats = [os.stat(os.path.join(via,i%name)) for i in ['%s.log','%s.script.sh']]
+		stamp = [j for i in stats for j in (i.st_size,i.st_mtime)]
+		for extra_fn in [os.path.join(via,i%name) for i in ['%s.stats.json','%s.complete.json']]:
+			if os.path.isfile(extra_fn): stamp += [os.path.getsize(extra_fn),os.path.getmtime(extra_fn)]
+		return stamp
+	def scan(name):
+		key,this_stamp = os.path.abspath(os.path.join(via,name)),stamp(name)
+		if key in cache and cache[key]['stamp']==this_stamp: return name,cache[key]['result']
+		result = megatest_scan(via,name)
+		cache[key] = dict(stamp=this_stamp,result=result)
+		return name,result
+	pool = ThreadPool(workers)
+	try: report = dict(pool.map(scan,names))
+	finally:
+		pool.close()
+		pool.join()
+	with open(cache_fn,'w') as fp: json.dump(cache,fp,default=str)
+	return report
+
+def megatest(instruct,via,check=False,clear=None,workers=1,json_fn=None,stats=None):
 	"""
 	The test to end all unit tests.
 	Run with `make megatest instruct=tests/megatest_v1.yaml via=logs`.
+	Use e.g. `workers=4` to run tests in parallel, longest first according to previous runs.
+	Use `check=True json_fn=report.json` to also write a machine-readable report.
+	Use `stats=1` to sample resources every second and report peak and mean use in the check.
 	If you ctrl+c out, then you have to remove the folder yourself (because some files are not written).
 	!!! add keyboard exception that cleans up.
 	"""
+	import shutil
 	import yaml,glob
 	# test sequence comes from a separate file
 	#! considered using wildcard to get tests matching a name from avail()
-	spec = yaml.load(open(instruct).read())
+	spec = yaml.safe_load(open(instruct).read())
 	# read a folder
 	if not os.path.isdir(via):
 		raise Exception('via argument %s must point to a folder with completed tests'%via)
@@ -573,36 +2896,23 @@ def megatest(instruct,via,check=False,clear=None):
 	test_names = list(base_logs)
 	# loop over tests
 	if not check and not clear:
+		todo = []
 		for name in spec['sequence']:
 			name_spaceless = '_'.join(name.split())
-			if name_spaceless not in test_names:
-				print('[STATUS] megatest is running test %s'%(name_spaceless))
-				# RUN THE TEST
-				# note that you can set visit below to drop in and see the container without executing
-				# ... which was useful for debugging the mounts
-				test(*name.split(),back=True,wait=True,log=True,visit=False,
-					dump_raw_test=os.path.join(via,'%s.yaml'%name_spaceless))
+			if name_spaceless not in test_names: todo.append(name)
 			else: print('[STATUS] megatest is skipping test %s because it is logged'%(name_spaceless))
+		workers = int(workers)
+		if workers>1 and len(todo)>1: megatest_parallel(todo,via,workers=workers,stats=stats)
+		else:
+			for name in todo: megatest_run(name,via,stats=stats)
 	else:
-		import yaml
 		from datapack import asciitree
-		report = {}
 		print('[STATUS] status report follows')
-		for name in test_names:
-			with open(os.path.join(via,'%s.log'%name),'r') as fp: text = fp.read()
-			passed = None!=re.search('unit test is complete',text)
-			report[name] = dict(passed=passed)
-			# collect special instructions if passed
-			try:
-				with open(os.path.join(via,'%s.script.sh'%name),'r') as fp: text = fp.read()
-				special = re.search('### special summary (.*?)\n',text,re.M).group(1)
-				report[name]['special'] = yaml.load(special)
-				try: 
-					spot = re.search('^spot=(.*?)\n',text,re.M).group(1).strip()
-					report[name]['spot'] = spot
-				except: pass
-			except: pass
+		report = megatest_report(via,test_names,workers=max(int(workers),8))
 		asciitree(report)
+		if json_fn:
+			with open(json_fn,'w') as fp: json.dump(report,fp,default=str,indent=2,sort_keys=True)
+			print('[STATUS] wrote the megatest report to %s'%json_fn)
 		if clear:
 			failed = [k for k,v in report.items() if not v['passed']]
 			for name in failed:
@@ -612,9 +2922,9 @@ def megatest(instruct,via,check=False,clear=None):
 							report[name]['special']['sim_name'])
 						shutil.rmtree(out_dn)
 					except: print('[WARNING] could not delete %s'%out_dn)
-					try: os.system('docker rm %s'%name)
-					except: pass
-					for base_fn in ['%s.log','%s.script.sh','%s.yaml']:
+					try: docker_backend().remove(name)
+					except DockerError: pass
+					for base_fn in ['%s.log','%s.script.sh','%s.yaml','%s.complete.json']:
 						try: os.remove(os.path.join(via,base_fn%name))
 						except: pass
 				except: print('[WARNING] perhaps failed to clear %s'%name)	